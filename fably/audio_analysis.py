@@ -0,0 +1,137 @@
+"""
+Analysis of the audio captured by the microphone.
+
+The analyzer computes the RMS energy and the spectrum of fixed-size blocks of samples with a precomputed
+window and buffers that are reused across blocks, so it's cheap enough to run on every block captured.
+
+It's also used to calibrate the noise floor of the room at startup: the silence threshold derived from it
+lets the silence detector tell the recorder when the child stopped talking even in noisy rooms.
+"""
+
+import logging
+
+import numpy as np
+import sounddevice as sd
+
+CALIBRATION_DURATION = 1.0
+NOISE_FLOOR_PERCENTILE = 90
+# Speech has to be this many times louder than the noise floor (about 8dB).
+SILENCE_FACTOR = 2.5
+MIN_SILENCE_THRESHOLD = 0.005
+
+
+class BlockAnalyzer:
+    """
+    Computes the RMS energy and the spectrum of blocks of samples of a fixed size.
+
+    Blocks can be int16 or float samples, energies and spectra are relative to full scale.
+    """
+
+    def __init__(self, block_size, fft_size=None):
+        self.block_size = block_size
+        self.fft_size = fft_size or block_size
+        self.window = np.hanning(block_size).astype(np.float32)
+        self.samples = np.empty(block_size, dtype=np.float32)
+        self.magnitude = np.empty(self.fft_size // 2 + 1, dtype=np.float32)
+
+    def _load(self, block):
+        block = np.asarray(block).reshape(-1)[: self.block_size]
+        samples = self.samples[: len(block)]
+        if block.dtype == np.int16:
+            np.multiply(block, 1 / 32768, out=samples, casting="unsafe")
+        else:
+            samples[:] = block
+        return samples
+
+    def rms(self, block):
+        """
+        Return the RMS energy of the given block.
+        """
+        samples = self._load(block)
+        if not samples.size:
+            return 0.0
+        return float(np.sqrt(np.dot(samples, samples) / len(samples)))
+
+    def spectrum(self, block):
+        """
+        Return the magnitude of the spectrum of the given block, windowed to avoid leakage.
+
+        The returned array is reused for the next block, copy it to keep it.
+        """
+        samples = self._load(block)
+        np.multiply(samples, self.window[: len(samples)], out=samples)
+        np.abs(np.fft.rfft(samples, n=self.fft_size), out=self.magnitude)
+        self.magnitude /= self.fft_size
+        return self.magnitude
+
+
+class SilenceDetector:
+    """
+    Tells when the sound stayed below a silence threshold for a given number of samples after speech was heard.
+    """
+
+    def __init__(self, block_size, threshold, silent_samples):
+        self.analyzer = BlockAnalyzer(block_size)
+        self.threshold = threshold
+        self.silent_samples = silent_samples
+        self.heard_speech = False
+        self.silence = 0
+
+    def is_done(self, block):
+        """
+        Analyze the given block and return whether speech was followed by enough silence.
+        """
+        if self.analyzer.rms(block) < self.threshold:
+            self.silence += len(block)
+        else:
+            self.heard_speech = True
+            self.silence = 0
+        return self.heard_speech and self.silence >= self.silent_samples
+
+
+def measure_noise_floor(
+    sample_rate, duration=CALIBRATION_DURATION, block_size=None, device=None
+):
+    """
+    Record the ambient sound for the given duration and return its noise floor, in RMS energy.
+
+    The noise floor is a high percentile of the energy of the recorded blocks, so that the
+    usual bumps of the background noise are below it.
+    """
+    block_size = block_size or sample_rate // 20
+    analyzer = BlockAnalyzer(block_size)
+    energies = []
+
+    def callback(indata, _frames, _time, _status):
+        energies.append(analyzer.rms(indata[:, 0]))
+
+    with sd.InputStream(
+        samplerate=sample_rate,
+        blocksize=block_size,
+        dtype="int16",
+        channels=1,
+        device=device,
+        callback=callback,
+    ):
+        sd.sleep(int(duration * 1000))
+
+    return float(np.percentile(energies, NOISE_FLOOR_PERCENTILE)) if energies else 0.0
+
+
+def silence_threshold(noise_floor):
+    """
+    Return the RMS energy below which sound is considered silence given the noise floor of the room.
+    """
+    return max(noise_floor * SILENCE_FACTOR, MIN_SILENCE_THRESHOLD)
+
+
+def calibrate_silence_threshold(sample_rate, duration=CALIBRATION_DURATION):
+    """
+    Measure the noise floor of the room and return the silence threshold derived from it.
+    """
+    noise_floor = measure_noise_floor(sample_rate, duration)
+    threshold = silence_threshold(noise_floor)
+    logging.debug(
+        "Calibrated silence threshold to %.4f (noise floor %.4f)", threshold, noise_floor
+    )
+    return threshold
@@ -0,0 +1,261 @@
+"""
+Offline generation of stories in bulk, e.g. to pre-populate the story cache of devices before shipping them.
+
+Queries are read from a JSONL file where each line is either a JSON string or an object with a "query" key.
+Stories are written in the stories path with the same layout as the ones generated interactively, and
+running the command again only generates the stories that are missing or were interrupted.
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+
+import click
+import openai
+
+from fably import cli
+from fably import fably
+from fably import replay
+from fably import utils
+from fably.cli_utils import Context
+
+CONCURRENCY = 4
+
+
+class RateLimiter:
+    """
+    Spaces out the requests to an endpoint so that no more than the given number are sent per minute.
+
+    It's an HTTPX request hook, so it covers every request sent by a client.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self.next_time = 0.0
+
+    async def __call__(self, _request):
+        now = time.monotonic()
+        wait = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def read_queries(queries_file):
+    """
+    Yield the queries in the given JSONL file.
+    """
+    with open(queries_file, "r", encoding="utf8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            yield entry["query"] if isinstance(entry, dict) else entry
+
+
+async def synthesize_story(ctx, story_queue):
+    """
+    Synthesize the audio of all the paragraphs of a story as the writer queues them.
+    """
+    syntheses = []
+    while True:
+        item = await story_queue.get()
+        if item is None:
+            break
+        syntheses.append(asyncio.create_task(fably.synthesize_audio(ctx, *item)))
+    await asyncio.gather(*syntheses)
+
+
+async def generate_story(ctx, query, semaphore):
+    """
+    Generate the story for the given query along with its audio, unless it's already in the cache.
+
+    Returns whether the story is now complete.
+    """
+    if not query.lower().startswith(ctx.query_guard):
+        logging.warning("Skipping '%s' since it doesn't start with '%s'", query, ctx.query_guard)
+        return False
+
+    story_path = ctx.stories_path / utils.query_to_filename(query, prefix=ctx.query_guard)
+    if replay.read_manifest(story_path):
+        logging.debug("Skipping '%s' since it's already in %s", query, story_path)
+        return True
+
+    async with semaphore:
+        logging.info("Generating '%s'...", query)
+        story_queue = asyncio.Queue()
+        try:
+            await asyncio.gather(
+                fably.writer(ctx, story_queue, query),
+                synthesize_story(ctx, story_queue),
+            )
+        except (openai.OpenAIError, OSError, ValueError) as e:
+            logging.error("Failed to generate '%s': %s", query, e)
+            return False
+
+    logging.info("Generated '%s' in %s", query, story_path)
+    return True
+
+
+async def generate_stories(ctx, queries, concurrency):
+    """
+    Generate the stories for all the given queries, running the given number of pipelines concurrently.
+
+    Returns the number of stories that are complete.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *[generate_story(ctx, query, semaphore) for query in queries]
+    )
+    return sum(results)
+
+
+@click.command()
+@click.argument("queries_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--prompt-file",
+    default=cli.PROMPT_FILE,
+    help=f'The file to use as the prompt when generating stories. Defaults to "{cli.PROMPT_FILE}".',
+)
+@click.option(
+    "--stories-path",
+    default=cli.STORIES_PATH,
+    help=f'The directory to store the generated stories in. Defaults to "{cli.STORIES_PATH}".',
+)
+@click.option(
+    "--llm-url",
+    default=cli.LLM_URL,
+    help=f'The URL of the LLM to use to generate stories. Defaults to "{cli.LLM_URL}".',
+)
+@click.option(
+    "--llm-model",
+    default=cli.LLM_MODEL,
+    help=f'The model to use for generating stories. Defaults to "{cli.LLM_MODEL}".',
+)
+@click.option(
+    "--llm-rate",
+    type=float,
+    default=0,
+    help="The maximum number of requests per minute to send to the LLM. Unlimited by default.",
+)
+@click.option(
+    "--temperature",
+    default=cli.TEMPERATURE,
+    help=f"The temperature to use when generating stories. Defaults to {cli.TEMPERATURE}.",
+)
+@click.option(
+    "--max-tokens",
+    default=cli.MAX_TOKENS,
+    help=f"The maximum number of tokens to use when generating stories. Defaults to {cli.MAX_TOKENS}.",
+)
+@click.option(
+    "--tts-url",
+    default=cli.TTS_URL,
+    help=f'The URL of the text-to-speech service. Defaults to "{cli.TTS_URL}".',
+)
+@click.option(
+    "--tts-model",
+    default=cli.TTS_MODEL,
+    help=f'The text-to-speech model to use. Defaults to "{cli.TTS_MODEL}".',
+)
+@click.option(
+    "--tts-voice",
+    default=cli.TTS_VOICE,
+    help=f'The voice to use for the text-to-speech service. Defaults to "{cli.TTS_VOICE}".',
+)
+@click.option(
+    "--tts-format",
+    default=cli.TTS_FORMAT,
+    help=f'The audio format to use for the text-to-speech service. Defaults to "{cli.TTS_FORMAT}".',
+)
+@click.option(
+    "--tts-rate",
+    type=float,
+    default=0,
+    help="The maximum number of requests per minute to send to the TTS service. Unlimited by default.",
+)
+@click.option(
+    "--language",
+    default=cli.LANGUAGE,
+    help=f'The language to use for generating stories. Defaults to "{cli.LANGUAGE}".',
+)
+@click.option(
+    "--query-guard",
+    default=cli.QUERY_GUARD,
+    help=f'The prefix the queries need to start with. Defaults to "{cli.QUERY_GUARD}".',
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    default=CONCURRENCY,
+    help=f"The number of stories to generate at the same time. Defaults to {CONCURRENCY}.",
+)
+@click.option("--debug", is_flag=True, default=False, help="Enables debug logging.")
+def main(
+    queries_file,
+    prompt_file,
+    stories_path,
+    llm_url,
+    llm_model,
+    llm_rate,
+    temperature,
+    max_tokens,
+    tts_url,
+    tts_model,
+    tts_voice,
+    tts_format,
+    tts_rate,
+    language,
+    query_guard,
+    concurrency,
+    debug,
+):
+    """
+    Generate the stories for all the queries in QUERIES_FILE.
+    """
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+
+    ctx = Context()
+    ctx.llm_url = llm_url
+    ctx.llm_model = llm_model
+    ctx.temperature = temperature
+    ctx.max_tokens = max_tokens
+    ctx.tts_url = tts_url
+    ctx.tts_model = tts_model
+    ctx.tts_voice = tts_voice
+    ctx.tts_format = tts_format
+    ctx.language = language
+    ctx.query_guard = query_guard
+    ctx.prompt_file = utils.resolve(prompt_file)
+    ctx.stories_path = utils.resolve(stories_path)
+    # Nobody is waiting for these stories: duplicate requests would only be billed and eat into the rate limits.
+    ctx.llm_latency.deadline = ctx.tts_latency.deadline = math.inf
+
+    ctx.api_key = os.getenv("OPENAI_API_KEY")
+    if ctx.api_key is None:
+        raise ValueError(
+            "OPENAI_API_KEY environment variable not set or .env file not found."
+        )
+
+    # Rate limits are per endpoint: when the LLM and TTS share one, the lowest of the two applies.
+    rates = {}
+    for url, rate in ((llm_url, llm_rate), (tts_url, tts_rate)):
+        if rate:
+            rates[url] = min(rate, rates.get(url, rate))
+    for url, rate in rates.items():
+        ctx.http_clients[url] = openai.DefaultAsyncHttpxClient(
+            event_hooks={"request": [RateLimiter(rate)]}
+        )
+
+    utils.migrate_legacy_stories(ctx.stories_path)
+
+    # Queries that only differ in case or punctuation are the same story, in the same directory.
+    stories = {}
+    for query in read_queries(queries_file):
+        stories.setdefault(utils.query_to_filename(query, prefix=ctx.query_guard), query)
+    queries = list(stories.values())
+    complete = asyncio.run(generate_stories(ctx, queries, concurrency))
+    click.echo(f"{complete} of {len(queries)} stories are complete in {ctx.stories_path}")
@@ -0,0 +1,163 @@
+"""
+Packed single-file format for cached stories.
+
+A story directory holds several small files per paragraph which is slow to read and wasteful of inodes
+on SD cards. A bundle packs the whole story in a single file laid out as:
+
+    MAGIC | header length (4 bytes, little endian) | JSON header | data
+
+The JSON header contains the story info and an index with, for each paragraph, the offset and length
+of its text and audio in the data section along with the duration of its audio. Bundles are memory-mapped
+when read so paragraphs are played straight from the page cache without copying them around.
+"""
+
+import io
+import json
+import mmap
+import struct
+
+import soundfile as sf
+import yaml
+
+from fably import utils
+
+MAGIC = b"FABLY\x00\x01\x00"
+BUNDLE_SUFFIX = "fably"
+
+
+def bundle_path(story_path):
+    """
+    Return the path of the bundle of the story at the given path.
+    """
+    return story_path.parent / f"{story_path.name}.{BUNDLE_SUFFIX}"
+
+
+def audio_duration(audio_data):
+    """
+    Return the duration of the given encoded audio in seconds, or None if it can't be decoded.
+    """
+    try:
+        return sf.info(io.BytesIO(audio_data)).duration
+    except (sf.LibsndfileError, RuntimeError, TypeError):
+        return None
+
+
+def pack_story(story_path, output_file=None):
+    """
+    Pack the story directory at the given path into a single bundle file and return its path.
+    """
+    output_file = output_file or bundle_path(story_path)
+
+    if not utils.is_story_complete(story_path):
+        raise ValueError(f"{story_path} was not completely generated")
+
+    info_file = story_path / "info.yaml"
+    info = yaml.safe_load(info_file.read_text(encoding="utf8")) if info_file.exists() else {}
+
+    audio_format = None
+    paragraphs = []
+    data = io.BytesIO()
+
+    for index in range(utils.count_paragraphs(story_path)):
+        text = (story_path / f"paragraph_{index}.txt").read_bytes()
+        audio_files = [
+            path
+            for path in story_path.glob(f"paragraph_{index}.*")
+            if path.suffix[1:] in utils.AUDIO_FORMATS
+        ]
+        if not audio_files:
+            raise ValueError(f"No audio found for paragraph {index} in {story_path}")
+
+        audio_file = audio_files[0]
+        audio_format = audio_format or audio_file.suffix[1:]
+        if audio_file.suffix[1:] != audio_format:
+            raise ValueError(f"Mixed audio formats in {story_path}")
+        audio = audio_file.read_bytes()
+
+        text_offset = data.tell()
+        data.write(text)
+        audio_offset = data.tell()
+        data.write(audio)
+
+        paragraphs.append(
+            {
+                "text": [text_offset, len(text)],
+                "audio": [audio_offset, len(audio)],
+                "duration": audio_duration(audio),
+            }
+        )
+
+    header = json.dumps(
+        {"info": info, "audio_format": audio_format, "paragraphs": paragraphs}
+    ).encode("utf8")
+
+    tmp_file = utils.temporary_path(output_file)
+    with open(tmp_file, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(data.getbuffer())
+    tmp_file.replace(output_file)
+
+    return output_file
+
+
+class StoryBundle:
+    """
+    Read-only, memory-mapped view of a story bundle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[: len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a story bundle.")
+
+        header_start = len(MAGIC) + 4
+        (header_length,) = struct.unpack_from("<I", self.mmap, len(MAGIC))
+        header = json.loads(self.mmap[header_start : header_start + header_length])
+
+        self.info = header["info"]
+        self.audio_format = header["audio_format"]
+        self.paragraphs = header["paragraphs"]
+        self.data_start = header_start + header_length
+
+    def __len__(self):
+        return len(self.paragraphs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _slice(self, offset, length):
+        start = self.data_start + offset
+        return memoryview(self.mmap)[start : start + length]
+
+    def text(self, index):
+        """
+        Return the text of the given paragraph.
+        """
+        return str(self._slice(*self.paragraphs[index]["text"]), "utf8")
+
+    def audio(self, index):
+        """
+        Return the encoded audio of the given paragraph as a view into the mapped bundle.
+        """
+        return self._slice(*self.paragraphs[index]["audio"])
+
+    def duration(self, index):
+        """
+        Return the duration in seconds of the audio of the given paragraph, if known.
+        """
+        return self.paragraphs[index]["duration"]
+
+    def close(self):
+        """
+        Unmap the bundle.
+        """
+        self.mmap.close()
@@ -0,0 +1,66 @@
+"""
+Sizing of the chunks of a story sent to the TTS service.
+
+The paragraphs generated by the LLM vary a lot in size: tiny ones waste a TTS round trip each, huge
+ones take long to synthesize and delay the audio. Paragraphs are merged until they reach a target size
+and the ones that would make a chunk much larger than that are split between their sentences. The first
+chunk can be smaller so that the story starts playing sooner.
+
+Chunks are what gets cached as paragraph_N, so replaying a story plays the same chunks.
+"""
+
+import re
+
+CHUNK_SIZE = 500
+FIRST_CHUNK_SIZE = 150
+# Paragraphs are only split if they'd make a chunk this many times larger than the target.
+MAX_CHUNK_FACTOR = 2
+
+SENTENCE_END = re.compile(r"(?<=[.!?])[\"'”’)]*\s+")
+
+
+def split_sentences(text):
+    """
+    Split the given text into sentences, keeping the whitespace after each one.
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        sentences.append(text[start : match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+async def chunk_paragraphs(paragraphs, chunk_size=CHUNK_SIZE, first_chunk_size=None):
+    """
+    Yield chunks of about the given size, in characters, made of the given paragraphs as they come.
+
+    The first chunk is about the given first chunk size, if any. A chunk size of 0 leaves paragraphs as they are.
+    """
+    chunk = ""
+    target_size = first_chunk_size or chunk_size
+
+    async for paragraph in paragraphs:
+        if not chunk_size:
+            yield paragraph
+            continue
+
+        if len(chunk) + len(paragraph) <= target_size * MAX_CHUNK_FACTOR:
+            chunk += paragraph
+        else:
+            for sentence in split_sentences(paragraph):
+                if chunk and len(chunk) + len(sentence) > target_size:
+                    yield chunk
+                    chunk = ""
+                    target_size = chunk_size
+                chunk += sentence
+
+        if len(chunk) >= target_size:
+            yield chunk
+            chunk = ""
+            target_size = chunk_size
+
+    if chunk:
+        yield chunk
@@ -12,6 +12,7 @@ import click
 from dotenv import load_dotenv
 
 from fably import fably
+from fably import ollama
 from fably import utils
 from fably import leds
 
@@ -38,6 +39,14 @@ TTS_URL = OPENAI_URL
 TTS_MODEL = "tts-1"
 TTS_VOICE = "nova"
 TTS_FORMAT = "mp3"
+MAX_TTS_LOOKAHEAD = 4
+TTS_CHUNK_SIZE = 500
+TTS_FIRST_CHUNK_SIZE = 150
+LLM_DEADLINE = 5.0
+LLM_STALL_TIMEOUT = 15.0
+LLM_KEEP_ALIVE = "10m"
+TTS_DEADLINE = 5.0
+AUDIO_CACHE_FORMAT = "original"
 LANGUAGE = "en"
 BUTTON_GPIO_PIN = 17
 HOLD_TIME = 3
@@ -51,6 +60,31 @@ STARTING_COLORS = [0xFF0000, 0xFF0000, 0xFF0000]
 load_dotenv()
 
 
+def parse_usage_hours(_ctx, _param, value):
+    """
+    Parse usage hours given as START-END into a (start, end) pair of hours.
+    """
+    if value is None:
+        return None
+    try:
+        return ollama.parse_usage_hours(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e)) from e
+
+
+def parse_endpoints(_ctx, _param, values):
+    """
+    Parse endpoints given as MODEL@URL into (model, url) pairs.
+    """
+    endpoints = []
+    for value in values:
+        model, _, url = value.partition("@")
+        if not model or not url:
+            raise click.BadParameter(f'"{value}" is not in the MODEL@URL form.')
+        endpoints.append((model, url))
+    return endpoints
+
+
 @click.command()
 @click.argument("query", required=False, default=None, nargs=1)
 @click.option(
@@ -93,6 +127,13 @@ load_dotenv()
     default=STT_MODEL,
     help=f'The STT model to use when generating stories. Defaults to "{STT_MODEL}".',
 )
+@click.option(
+    "--local-stt-confidence",
+    type=float,
+    default=None,
+    help="The confidence (0 to 1) above which the local transcript of a voice query is used instead of the "
+    "STT service when it matches a cached story. By default the STT service is always used.",
+)
 @click.option(
     "--llm-url",
     default=LLM_URL,
@@ -115,6 +156,52 @@ load_dotenv()
     default=MAX_TOKENS,
     help="The maximum number of tokens to use when generating stories. Defaults to {MAX_TOKENS}.",
 )
+@click.option(
+    "--llm-hedge-url",
+    default=None,
+    help="The URL of an alternate LLM endpoint to send hedged requests to. Defaults to the LLM URL.",
+)
+@click.option(
+    "--llm-deadline",
+    type=float,
+    default=LLM_DEADLINE,
+    help="How long to wait for the first token of a story before hedging the request, until the 95th "
+    f"percentile of the recent requests is known. Defaults to {LLM_DEADLINE} seconds.",
+)
+@click.option(
+    "--llm-stall-timeout",
+    type=float,
+    default=LLM_STALL_TIMEOUT,
+    help="How long the story stream can go without producing anything before it's retried from the last "
+    f"complete paragraph. Defaults to {LLM_STALL_TIMEOUT} seconds.",
+)
+@click.option(
+    "--llm-keep-alive",
+    default=LLM_KEEP_ALIVE,
+    help="How long an LLM served by Ollama stays loaded after a story outside of the usage hours, "
+    f'e.g. "30m" or "-1" for ever. Defaults to "{LLM_KEEP_ALIVE}".',
+)
+@click.option(
+    "--llm-usage-hours",
+    default=None,
+    callback=parse_usage_hours,
+    help='The hours of the day Fably is used, as START-END (e.g. "7-21"). An LLM served by Ollama is kept '
+    "loaded during them, so that no story waits for it to load.",
+)
+@click.option(
+    "--llm-race",
+    multiple=True,
+    callback=parse_endpoints,
+    help=f'Another LLM endpoint, as MODEL@URL (e.g. "llama3@{OLLAMA_URL}"), to race against the main one. '
+    "Each story is requested from all of them at once and the first to answer wins. Can be repeated.",
+)
+@click.option(
+    "--llm-race-until",
+    type=click.Choice(["first-token", "first-paragraph"], case_sensitive=False),
+    default="first-token",
+    help="Whether racing LLM endpoints commit to the first one producing a token or a whole paragraph. "
+    'Defaults to "first-token".',
+)
 @click.option(
     "--tts-url",
     default=LLM_URL,
@@ -135,6 +222,46 @@ load_dotenv()
     default=TTS_FORMAT,
     help=f'The TTS format to use when generating stories. Defaults to "{TTS_FORMAT}".',
 )
+@click.option(
+    "--tts-hedge-url",
+    default=None,
+    help="The URL of an alternate TTS endpoint to send hedged requests to. Defaults to the TTS URL.",
+)
+@click.option(
+    "--tts-deadline",
+    type=float,
+    default=TTS_DEADLINE,
+    help="How long to wait for the audio of a paragraph before hedging the request, until the 95th "
+    f"percentile of the recent requests is known. Defaults to {TTS_DEADLINE} seconds.",
+)
+@click.option(
+    "--tts-race",
+    multiple=True,
+    callback=parse_endpoints,
+    help="Another TTS endpoint, as MODEL@URL, to race against the main one. "
+    "Each paragraph is requested from all of them at once and the first to answer wins. Can be repeated.",
+)
+@click.option(
+    "--max-tts-lookahead",
+    type=click.IntRange(min=1),
+    default=MAX_TTS_LOOKAHEAD,
+    help="The maximum number of paragraphs to synthesize ahead of the one being played. The actual number "
+    f"adapts to how fast the TTS service is compared to playback. Defaults to {MAX_TTS_LOOKAHEAD}.",
+)
+@click.option(
+    "--tts-chunk-size",
+    type=int,
+    default=TTS_CHUNK_SIZE,
+    help="The size, in characters, that paragraphs are merged or split into before being synthesized. "
+    f"0 keeps the paragraphs as they are generated. Defaults to {TTS_CHUNK_SIZE}.",
+)
+@click.option(
+    "--tts-first-chunk-size",
+    type=int,
+    default=TTS_FIRST_CHUNK_SIZE,
+    help="The size, in characters, of the first chunk of a story, smaller so that it starts playing sooner. "
+    f"Defaults to {TTS_FIRST_CHUNK_SIZE}.",
+)
 @click.option(
     "--language",
     default=LANGUAGE,
@@ -145,6 +272,25 @@ load_dotenv()
     default=QUERY_GUARD,
     help=f'The text each query has to start with. Defaults to "{QUERY_GUARD}".',
 )
+@click.option(
+    "--shared-cache-url",
+    default=None,
+    help="The URL of the story cache server shared by a fleet of devices. Disabled by default.",
+)
+@click.option(
+    "--audio-cache-format",
+    type=click.Choice(["original", "pcm", "opus"], case_sensitive=False),
+    default=AUDIO_CACHE_FORMAT,
+    help="The format to store the audio of cached stories in: the original one from the TTS service, "
+    "uncompressed PCM (largest, cheapest to play) or Opus (smallest). Transcoding happens in the background "
+    f'when idle. Defaults to "{AUDIO_CACHE_FORMAT}".',
+)
+@click.option(
+    "--render-stories/--no-render-stories",
+    default=True,
+    help="Whether to render each cached story into a single audio file in the background, "
+    "so that replaying it plays one continuous file. Defaults to rendering.",
+)
 @click.option("--debug", is_flag=True, default=False, help="Enables debug logging.")
 @click.option(
     "--ignore_cache",
@@ -152,6 +298,18 @@ load_dotenv()
     default=False,
     help="Ignores the cache and always generates a new story.",
 )
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Whether to continue interrupted stories from their last complete paragraph "
+    "instead of generating them again. Defaults to resuming.",
+)
+@click.option(
+    "--speculate/--no-speculate",
+    default=True,
+    help="Whether to start creating the story from the local transcript of the voice query while the STT "
+    "service transcribes it, starting over if the transcripts differ. Defaults to speculating.",
+)
 @click.option(
     "--sound-driver",
     type=click.Choice(["alsa", "sounddevice"], case_sensitive=False),
@@ -164,6 +322,13 @@ load_dotenv()
     default=False,
     help="Trim the first frame of recorded audio data. Useful if the mic has a click or hiss at the beginning of each recording.",
 )
+@click.option(
+    "--silence-threshold",
+    type=float,
+    default=None,
+    help="The RMS energy (0 to 1) below which the voice query is considered over. By default it's calibrated "
+    "from the noise floor of the room at startup, 0 leaves it to the speech recognizer alone.",
+)
 @click.option(
     "--button-gpio-pin",
     type=int,
@@ -177,6 +342,12 @@ load_dotenv()
     help="The time to hold the button to erase all recorded sounds. Defaults to {HOLD_TIME} seconds.",
 )
 @click.option("--loop", is_flag=True, default=False, help="Enables loop operation.")
+@click.option(
+    "--wake-phrase",
+    is_flag=True,
+    default=False,
+    help="Listens for the query guard to start a story hands-free, in addition to the button.",
+)
 @pass_context
 def cli(
     ctx,
@@ -189,23 +360,44 @@ def cli(
     sound_model,
     stt_url,
     stt_model,
+    local_stt_confidence,
     llm_url,
     llm_model,
     temperature,
     max_tokens,
+    llm_hedge_url,
+    llm_deadline,
+    llm_stall_timeout,
+    llm_keep_alive,
+    llm_usage_hours,
+    llm_race,
+    llm_race_until,
     tts_url,
     tts_model,
     tts_voice,
     tts_format,
+    tts_hedge_url,
+    tts_deadline,
+    tts_race,
+    max_tts_lookahead,
+    tts_chunk_size,
+    tts_first_chunk_size,
     language,
     query_guard,
+    shared_cache_url,
+    audio_cache_format,
+    render_stories,
     debug,
     ignore_cache,
+    resume,
+    speculate,
     sound_driver,
     trim_first_frame,
+    silence_threshold,
     button_gpio_pin,
     hold_time,
     loop,
+    wake_phrase,
 ):
     if debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -215,6 +407,7 @@ def cli(
     ctx.sound_model = sound_model
     ctx.stt_url = stt_url
     ctx.stt_model = stt_model
+    ctx.local_stt_confidence = local_stt_confidence
     ctx.llm_url = llm_url
     ctx.llm_model = llm_model
     ctx.tts_url = tts_url
@@ -229,11 +422,38 @@ def cli(
     ctx.ignore_cache = ignore_cache
     ctx.debug = debug
     ctx.loop = loop
+    ctx.wake_phrase = wake_phrase
     ctx.sound_driver = sound_driver
     ctx.trim_first_frame = trim_first_frame
+    ctx.silence_threshold = silence_threshold
     ctx.button_gpio_pin = button_gpio_pin
     ctx.hold_time = hold_time
 
+    ctx.configure_llm(
+        hedge_url=llm_hedge_url,
+        deadline=llm_deadline,
+        stall_timeout=llm_stall_timeout,
+        keep_alive=llm_keep_alive,
+        usage_hours=llm_usage_hours,
+        race=llm_race,
+        race_until=llm_race_until,
+    )
+    ctx.configure_tts(
+        hedge_url=tts_hedge_url,
+        deadline=tts_deadline,
+        race=tts_race,
+        max_lookahead=max_tts_lookahead,
+        chunk_size=tts_chunk_size,
+        first_chunk_size=tts_first_chunk_size,
+    )
+    ctx.configure_stories(
+        resume=resume,
+        speculate=speculate,
+        shared_cache_url=shared_cache_url,
+        audio_cache_format=audio_cache_format,
+        render_stories=render_stories,
+    )
+
     ctx.prompt_file = utils.resolve(prompt_file)
     ctx.queries_path = utils.resolve(queries_path)
     ctx.stories_path = utils.resolve(stories_path)
@@ -2,9 +2,13 @@
 Utility functions for command lines.
 """
 
+import threading
+
 import click
+import openai
 
 from fably import utils
+from fably.hedging import LatencyTracker
 
 
 class Context:
@@ -17,12 +21,16 @@ class Context:
     def __init__(self):
         self.debug = False
         self.trim_first_frame = False
+        self.silence_threshold = None
+        self.wake_phrase = False
+        self.speech_model = None
         self.sounds_path = utils.resolve("sounds")
         self.sound_driver = "alsa"
         self.sample_rate = 16000
         self.language = "en"
         self.stt_url = None
         self.stt_model = None
+        self.local_stt_confidence = None
         self.llm_url = None
         self.llm_model = None
         self.temperature = 0
@@ -30,7 +38,112 @@ class Context:
         self.tts_url = None
         self.tts_model = None
         self.tts_voice = None
+        self.max_tts_lookahead = 4
+        self.tts_chunk_size = 500
+        self.tts_first_chunk_size = 150
+        self.llm_hedge_url = None
+        self.tts_hedge_url = None
+        self.llm_latency = LatencyTracker("LLM", 5.0)
+        self.tts_latency = LatencyTracker("TTS", 5.0)
+        self.llm_stall_timeout = 15.0
+        self.llm_stall_retries = 2
+        self.llm_keep_alive = "10m"
+        self.llm_usage_hours = None
+        self.llm_race = []
+        self.llm_race_until = "first-token"
+        self.tts_race = []
+        self.http_clients = {}
+        self._clients = {}
+        self.shared_cache_url = None
+        self.shared_cache = None
+        self.audio_cache_format = "original"
+        self.render_stories = True
+        self.ignore_cache = False
+        self.resume = True
+        self.speculate = True
+        self.stories_changed = threading.Event()
+        self.uploading = set()
+        self.playing = set()
         self.running = True
+        self.api_key = None
+        self._stt_client = None
+
+    # The clients are only created when they are first needed,
+    # replaying a cached story doesn't need any of them.
+
+    @property
+    def stt_client(self):
+        """The client of the speech-to-text service."""
+        if self._stt_client is None:
+            self._stt_client = openai.Client(base_url=self.stt_url, api_key=self.api_key)
+        return self._stt_client
+
+    @property
+    def llm_client(self):
+        """The client of the large language model service."""
+        return self.client_for(self.llm_url)
+
+    @property
+    def tts_client(self):
+        """The client of the text-to-speech service."""
+        return self.client_for(self.tts_url)
+
+    @property
+    def llm_hedge_client(self):
+        """The client that hedged requests to the large language model service are sent to."""
+        return self.client_for(self.llm_hedge_url or self.llm_url)
+
+    @property
+    def tts_hedge_client(self):
+        """The client that hedged requests to the text-to-speech service are sent to."""
+        return self.client_for(self.tts_hedge_url or self.tts_url)
+
+    def client_for(self, url):
+        """The client of the service at the given URL, shared by all the requests to it."""
+        if url not in self._clients:
+            self._clients[url] = openai.AsyncClient(
+                base_url=url, api_key=self.api_key, http_client=self.http_clients.get(url)
+            )
+        return self._clients[url]
+
+    def configure_llm(
+        self, *, hedge_url, deadline, stall_timeout, keep_alive, usage_hours, race, race_until
+    ):
+        """
+        Configures how the requests to the large language model service are hedged, raced and kept warm.
+        """
+        self.llm_hedge_url = hedge_url
+        self.llm_latency.deadline = deadline
+        self.llm_stall_timeout = stall_timeout
+        self.llm_keep_alive = keep_alive
+        self.llm_usage_hours = usage_hours
+        self.llm_race = race
+        self.llm_race_until = race_until
+
+    def configure_tts(
+        self, *, hedge_url, deadline, race, max_lookahead, chunk_size, first_chunk_size
+    ):
+        """
+        Configures how the requests to the text-to-speech service are hedged, raced, scheduled and sized.
+        """
+        self.tts_hedge_url = hedge_url
+        self.tts_latency.deadline = deadline
+        self.tts_race = race
+        self.max_tts_lookahead = max_lookahead
+        self.tts_chunk_size = chunk_size
+        self.tts_first_chunk_size = first_chunk_size
+
+    def configure_stories(
+        self, *, resume, speculate, shared_cache_url, audio_cache_format, render_stories
+    ):
+        """
+        Configures how stories are resumed, speculatively created, shared and kept in the cache.
+        """
+        self.resume = resume
+        self.speculate = speculate
+        self.shared_cache_url = shared_cache_url
+        self.audio_cache_format = audio_cache_format
+        self.render_stories = render_stories
 
     def persist_runtime_params(self, output_file, **kwargs):
         """
@@ -4,36 +4,66 @@ Main Fably logic.
 
 import asyncio
 import concurrent.futures
+import functools
 import logging
 import shutil
 import time
 import threading
 
-import openai
-
 try:
     from gpiozero import Button
 except (ImportError, NotImplementedError):
     Button = None
 
+from fably import audio_analysis
+from fably import bundle
+from fably import chunking
+from fably import hedging
+from fably import ollama
+from fably import render
+from fably import replay
+from fably import transcode
 from fably import utils
+from fably import wake
+from fably import warmup
+from fably.lookahead import LookaheadScheduler
+from fably.shared_cache import SharedStoryCache
+
+RESUME_PROMPT = "Continue the story exactly where it stopped, without repeating any of it."
 
 
-def generate_story(ctx, query, prompt):
+def generate_story(
+    ctx, query, prompt, story_so_far=None, *, llm_client=None, llm_model=None
+):
     """
     Generates a story stream based on a given query and prompt using the OpenAI API and persists the information
     about the models used to generate the story to a file.
-    """
 
-    return ctx.llm_client.chat.completions.create(
+    If the beginning of the story is given, the stream continues it from there.
+    """
+    llm_client = llm_client or ctx.llm_client
+    messages = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": query},
+    ]
+    if story_so_far:
+        messages += [
+            {"role": "assistant", "content": "".join(story_so_far)},
+            {"role": "user", "content": RESUME_PROMPT},
+        ]
+
+    # Ollama keeps the model loaded after the request for as long as it's asked to.
+    extra_body = None
+    if ollama.is_ollama(llm_client.base_url):
+        extra_body = {"keep_alive": ollama.keep_alive(ctx)}
+
+    return llm_client.chat.completions.create(
         stream=True,
-        model=ctx.llm_model,
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": query},
-        ],
+        model=llm_model or ctx.llm_model,
+        messages=messages,
         temperature=ctx.temperature,
         max_tokens=ctx.max_tokens,
+        extra_body=extra_body,
     )
 
 
@@ -43,12 +73,14 @@ async def synthesize_audio(ctx, story_path, index, text=None):
     """
     logging.debug("Synthesizing audio for paragraph %i...", index)
 
-    audio_file_path = story_path / f"paragraph_{index}.{ctx.tts_format}"
-
-    if audio_file_path.exists():
+    # The cached audio might have been transcoded to a different format.
+    audio_file_path = utils.find_paragraph_audio(story_path, index, ctx.tts_format)
+    if audio_file_path:
         logging.debug("Paragraph %i audio already exists at %s", index, audio_file_path)
         return audio_file_path
 
+    audio_file_path = story_path / f"paragraph_{index}.{ctx.tts_format}"
+
     if not text:
         text_file_path = story_path / f"paragraph_{index}.txt"
         if text_file_path.exists():
@@ -59,50 +91,431 @@ async def synthesize_audio(ctx, story_path, index, text=None):
         else:
             raise ValueError(f"No text found for paragraph {index} in {story_path}")
 
-    response = await ctx.tts_client.audio.speech.create(
-        input=text,
-        model=ctx.tts_model,
-        voice=ctx.tts_voice,
-        response_format=ctx.tts_format,
-    )
+    def request(tts_client, tts_model):
+        return tts_client.audio.speech.create(
+            input=text,
+            model=tts_model,
+            voice=ctx.tts_voice,
+            response_format=ctx.tts_format,
+        )
+
+    if ctx.tts_race:
+        endpoints = [(ctx.tts_client, ctx.tts_model)] + [
+            (ctx.client_for(url), model) for model, url in ctx.tts_race
+        ]
+        winner, response = await hedging.race(
+            [request(*endpoint) for endpoint in endpoints]
+        )
+        logging.debug("TTS endpoint %i won the race for paragraph %i", winner, index)
+    else:
+        response = await hedging.hedged(
+            lambda attempt: request(
+                ctx.tts_hedge_client if attempt else ctx.tts_client, ctx.tts_model
+            ),
+            ctx.tts_latency,
+        )
 
     logging.debug("Saving audio for paragraph %i...", index)
-    response.write_to_file(audio_file_path)
+    tmp_file_path = utils.temporary_path(audio_file_path)
+    response.write_to_file(tmp_file_path)
+    tmp_file_path.replace(audio_file_path)
     logging.debug("Paragraph %i audio saved at %s", index, audio_file_path)
 
     return audio_file_path
 
 
-async def writer(ctx, story_queue, query=None):
+async def open_story_stream(ctx, query, prompt, story_so_far):
+    """
+    Opens a story stream, hedging it if its first fragment takes too long to arrive.
+
+    When racing endpoints, the stream is opened on all of them and the first one to produce
+    its first fragment (or its first paragraph) wins.
+
+    Returns the chunks read so far, the stream and the iterator over the rest of it.
+    """
+    first_paragraph = ctx.llm_race and ctx.llm_race_until == "first-paragraph"
+
+    async def first_chunks(llm_client, llm_model):
+        stream = await generate_story(
+            ctx, query, prompt, story_so_far, llm_client=llm_client, llm_model=llm_model
+        )
+        # The aiter() and anext() builtins need Python 3.10, Raspberry Pi OS Bullseye has 3.9.
+        iterator = stream.__aiter__()  # pylint: disable=unnecessary-dunder-call
+        chunks = []
+        try:
+            while True:
+                chunks.append(await iterator.__anext__())  # pylint: disable=unnecessary-dunder-call
+                fragment = chunks[-1].choices[0].delta.content
+                if not first_paragraph or fragment is None or fragment.endswith("\n\n"):
+                    return chunks, stream, iterator
+        except StopAsyncIteration:
+            if not chunks:
+                await stream.close()
+                raise ValueError("The story stream ended before it started.") from None
+            return chunks, stream, iterator
+        except BaseException:
+            await stream.close()
+            raise
+
+    async def discard(result):
+        await result[1].close()
+
+    if ctx.llm_race:
+        endpoints = [(ctx.llm_client, ctx.llm_model)] + [
+            (ctx.client_for(url), model) for model, url in ctx.llm_race
+        ]
+        winner, result = await hedging.race(
+            [first_chunks(*endpoint) for endpoint in endpoints], discard
+        )
+        logging.debug("LLM endpoint %i won the race", winner)
+        return result
+
+    return await hedging.hedged(
+        lambda attempt: first_chunks(
+            ctx.llm_hedge_client if attempt else ctx.llm_client, ctx.llm_model
+        ),
+        ctx.llm_latency,
+        discard,
+    )
+
+
+async def is_model_cold(ctx):
+    """
+    Check whether the model has to be loaded before it can generate the story, when Ollama can tell.
+    """
+    if not ollama.is_ollama(ctx.llm_url):
+        return None
+    loop = asyncio.get_running_loop()
+    loaded = await loop.run_in_executor(
+        None, ollama.is_model_loaded, ctx.llm_url, ctx.llm_model
+    )
+    return None if loaded is None else not loaded
+
+
+async def stream_paragraphs(ctx, query, prompt, story_so_far, stats=None):
+    """
+    Yields the paragraphs of the story as they are generated, appending them to the story so far.
+
+    If the stream stalls, it is abandoned and a new one continues the story
+    from the last complete paragraph.
+
+    The time it took for the first fragment to arrive, and whether the model was cold,
+    are reported and recorded in the given stats.
+    """
+    stats = {} if stats is None else stats
+    # Whether the model is cold is checked while the stream opens, so that it doesn't delay it.
+    cold_check = asyncio.create_task(is_model_cold(ctx))
+    start_time = time.monotonic()
+
+    for attempt in range(ctx.llm_stall_retries + 1):
+        chunks, stream, iterator = await open_story_stream(
+            ctx, query, prompt, story_so_far
+        )
+        if not attempt:
+            # Never wait for it: an Ollama server too busy to answer right away can't tell.
+            cold = cold_check.result() if cold_check.done() else None
+            cold_check.cancel()
+            stats["llm_first_token"] = round(time.monotonic() - start_time, 3)
+            if cold is not None:
+                stats["llm_cold_start"] = cold
+            logging.info(
+                "First story fragment after %.2fs%s",
+                stats["llm_first_token"],
+                {None: "", True: " from a cold model", False: " from a warm model"}[cold],
+            )
+        paragraph = []
+        try:
+            while True:
+                if chunks:
+                    chunk = chunks.pop(0)
+                else:
+                    chunk = await asyncio.wait_for(
+                        iterator.__anext__(), ctx.llm_stall_timeout  # pylint: disable=unnecessary-dunder-call
+                    )
+
+                fragment = chunk.choices[0].delta.content
+                if fragment is None:
+                    return
+
+                paragraph.append(fragment)
+
+                if fragment.endswith("\n\n"):
+                    story_so_far.append("".join(paragraph))
+                    yield story_so_far[-1]
+                    paragraph = []
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            logging.warning(
+                "The story stream stalled for %.1fs after %i paragraphs (attempt %i)",
+                ctx.llm_stall_timeout,
+                len(story_so_far),
+                attempt + 1,
+            )
+        finally:
+            await stream.close()
+
+    raise TimeoutError(f"The story stream stalled {ctx.llm_stall_retries + 1} times")
+
+
+class SpeculativeStory:
+    """
+    A story generated in the background from a tentative query, until it's either continued or cancelled.
+    """
+
+    def __init__(self, ctx, query, prompt):
+        self.query = query
+        self.stats = {}
+        self.paragraphs = asyncio.Queue()
+        self.task = asyncio.create_task(self._generate(ctx, prompt))
+        self.task.add_done_callback(self._done)
+
+    async def _generate(self, ctx, prompt):
+        try:
+            async for paragraph in stream_paragraphs(
+                ctx, self.query, prompt, [], self.stats
+            ):
+                await self.paragraphs.put(paragraph)
+        finally:
+            self.paragraphs.put_nowait(None)
+
+    @staticmethod
+    def _done(task):
+        if not task.cancelled() and task.exception():
+            logging.debug("The speculative story failed: %s", task.exception())
+
+    async def __aiter__(self):
+        while True:
+            paragraph = await self.paragraphs.get()
+            if paragraph is None:
+                break
+            yield paragraph
+        await self.task  # Raises the error that ended the story early, if any
+
+    def cancel(self):
+        """
+        Stop generating the story.
+        """
+        self.task.cancel()
+
+
+async def replay_story(ctx, story_queue, story_path, manifest):
+    """
+    Plays a complete cached story, then tells the reader and speaker that there's nothing for them to do.
+    """
+    logging.debug("Replaying cached story at %s", story_path)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, replay.play_story, ctx, manifest)
+    await story_queue.put(None)  # Indicates that we're done
+
+
+def prepare_story(ctx, follow_up):
+    """
+    Gets ready to tell a story while the child is still saying which one.
+    The connections to the services are already being warmed up by then.
+    """
+    follow_up["prompt"] = utils.read_from_file(ctx.prompt_file)
+
+
+def is_cached_query(ctx, query_local, confidence):
+    """
+    Check whether the local transcript of a voice query is confident enough and matches a cached story,
+    in which case there's no need to send the voice query to the speech-to-text service.
+    """
+    if ctx.local_stt_confidence is None or ctx.ignore_cache:
+        return False
+    if confidence < ctx.local_stt_confidence or not query_local.startswith(ctx.query_guard):
+        return False
+
+    story_path = ctx.stories_path / utils.query_to_filename(
+        query_local, prefix=ctx.query_guard
+    )
+    return bundle.bundle_path(story_path).exists() or utils.is_story_complete(story_path)
+
+
+def speculate(ctx, query_local, follow_up):
+    """
+    Starts generating the story for the local transcript of a voice query while the cloud one is on its way.
+
+    Returns the speculative story, or None if the local transcript isn't the query of a new story.
+    """
+    if not ctx.speculate or not utils.match_query_guard(query_local, ctx.query_guard):
+        return None
+
+    story_path = ctx.stories_path / utils.query_to_filename(
+        query_local, prefix=ctx.query_guard
+    )
+    if not ctx.ignore_cache and (
+        story_path.exists() or bundle.bundle_path(story_path).exists()
+    ):
+        return None
+
+    if "prompt" not in follow_up:
+        follow_up["prompt"] = utils.read_from_file(ctx.prompt_file)
+
+    logging.debug("Speculatively creating the story for '%s'...", query_local)
+    return SpeculativeStory(ctx, query_local, follow_up["prompt"])
+
+
+async def writer(ctx, story_queue, query=None, preroll=None):
     """
     Creates a story based on a voice query.
 
     If a textual query is given, it is used. If not, it records sound until silence,
-    then transcribes the voice query.
-
-    Then it uses a large generative language model to create a story based on the query,
-    processes the returned content as a stream, chunks it into paragraphs and appends them
-    to the queue for downstream processing.
+    then transcribes the voice query. When the query was started hands-free, the audio
+    heard with the wake phrase is the beginning of the recording. Voice queries that clearly
+    don't start with the query guard are turned down before they're sent to be transcribed,
+    and the ones confidently transcribed locally into the query of a cached story aren't sent.
+    While the voice query is being transcribed, the story is speculatively created from
+    its local transcript.
+
+    Then the story is told with write_story.
     """
+    follow_up = {}
+    speculation = None
     if query:
         query_local = "n/a"
         voice_query_file = None
     else:
-        utils.play_sound("what_story", audio_driver=ctx.sound_driver)
+        # Sound is played and recorded in the executor so that the services can be warmed up meanwhile.
+        loop = asyncio.get_running_loop()
+
+        # Whoever said the wake phrase is already telling us the story they want.
+        if not preroll:
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    utils.play_sound, "what_story", audio_driver=ctx.sound_driver
+                ),
+            )
 
-        voice_query, query_sample_rate, query_local = utils.record_until_silence(
-            ctx.recognizer, ctx.trim_first_frame
-        )
-        query, voice_query_file = utils.transcribe(
-            ctx.stt_client,
-            voice_query,
-            ctx.stt_model,
-            ctx.language,
-            query_sample_rate,
-            ctx.queries_path,
+        voice_query, query_sample_rate, query_local, confidence = await loop.run_in_executor(
+            None,
+            functools.partial(
+                utils.record_until_silence,
+                ctx.recognizer,
+                ctx.trim_first_frame and not preroll,
+                silence_threshold=ctx.silence_threshold,
+                preroll=preroll,
+                query_guard=ctx.query_guard,
+                on_guard=lambda: prepare_story(ctx, follow_up),
+            ),
         )
+        if utils.match_query_guard(query_local, ctx.query_guard) is False:
+            query, voice_query_file = query_local, None
+        elif is_cached_query(ctx, query_local, confidence):
+            logging.debug("Using the local transcript with confidence %.2f", confidence)
+            query, voice_query_file = query_local, None
+        else:
+            speculation = speculate(ctx, query_local, follow_up)
+            query, voice_query_file = await loop.run_in_executor(
+                None,
+                utils.transcribe,
+                ctx.stt_client,
+                voice_query,
+                ctx.stt_model,
+                ctx.language,
+                query_sample_rate,
+                ctx.queries_path,
+            )
         logging.info("Voice query: %s [%s]", query, query_local)
 
+    if speculation and not utils.same_query(speculation.query, query):
+        logging.info("The voice query isn't what it seemed, restarting the story")
+        speculation.cancel()
+        speculation = None
+
+    try:
+        return await write_story(
+            ctx,
+            story_queue,
+            query,
+            query_local,
+            voice_query_file,
+            prompt=follow_up.get("prompt"),
+            speculation=speculation,
+        )
+    finally:
+        if speculation:
+            speculation.cancel()
+
+
+async def look_up_story(ctx, story_path, shared_key):
+    """
+    Looks the story at the given path up in the local cache, then in the shared cache.
+
+    Returns the manifest to replay the story with if it's complete. If not, returns the paragraphs
+    of the story so far, which are all of them if only their audio is missing, or None if the story
+    has to be written from scratch.
+    """
+    if ctx.ignore_cache:
+        return None, None
+
+    # Complete cached stories are replayed right away, without going through the reader and the speaker.
+    manifest = replay.read_manifest(story_path)
+    if manifest:
+        return manifest, None
+
+    if shared_key and not story_path.exists():
+        logging.debug("Looking up the story in the shared cache...")
+        loop = asyncio.get_running_loop()
+        found = await loop.run_in_executor(
+            None, ctx.shared_cache.download, shared_key, story_path
+        )
+        manifest = replay.read_manifest(story_path) if found else None
+        if manifest:
+            return manifest, None
+
+    resumable = ctx.resume and (story_path / "info.yaml").exists()
+    if not utils.is_story_complete(story_path) and not resumable:
+        return None, None
+
+    # Every paragraph text on disk is complete since they are written atomically,
+    # so an interrupted story picks up right after the last one.
+    return None, [
+        utils.read_from_file(story_path / f"paragraph_{index}.txt")
+        for index in range(utils.count_paragraphs(story_path))
+    ]
+
+
+def create_story_folder(ctx, story_path, query, query_local):
+    """
+    Creates the folder of a new story at the given path, replacing any stale story there,
+    with the info about the models used to write it.
+    """
+    if story_path.exists():
+        logging.debug("Removing the stale story at %s", story_path)
+        shutil.rmtree(story_path)
+
+    logging.debug("Creating story folder at %s", story_path)
+    story_path.mkdir(parents=True, exist_ok=True)
+
+    logging.debug("Writing model info to disk...")
+    ctx.persist_runtime_params(
+        story_path / "info.yaml",
+        query=query,
+        query_local=query_local,
+    )
+
+
+async def write_story(
+    ctx,
+    story_queue,
+    query,
+    query_local,
+    voice_query_file,
+    *,
+    prompt=None,
+    speculation=None,
+):
+    """
+    Tells the story for the given query, replaying it from the cache when possible.
+
+    If not, it uses a large generative language model to create a story based on the query,
+    processes the returned content as a stream, chunks it into paragraphs and appends them
+    to the queue for downstream processing. A story speculatively created for the same
+    query is continued instead of being created again.
+    """
     if not query.lower().startswith(ctx.query_guard):
         logging.warning(
             "Sorry, I can only run queries that start with '%s' and '%s' does not",
@@ -111,71 +524,96 @@ async def writer(ctx, story_queue, query=None):
         )
         utils.play_sound("sorry", audio_driver=ctx.sound_driver)
         await story_queue.put(None)  # Indicates that we're done
-        return
+        return None, None
 
     story_path = ctx.stories_path / utils.query_to_filename(
         query, prefix=ctx.query_guard
     )
-    if ctx.ignore_cache or (
-        not ctx.ignore_cache and not story_path.exists() and not story_path.is_dir()
-    ):
-        logging.debug("Creating story folder at %s", story_path)
-        story_path.mkdir(parents=True, exist_ok=True)
-
-        logging.debug("Writing model info to disk...")
-        ctx.persist_runtime_params(
-            story_path / "info.yaml",
-            query=query,
-            query_local=query_local,
-        )
-
-        # This file will not exist when the query is passed as an argument
-        if voice_query_file:
-            logging.debug("Copying the original voice query...")
-            shutil.move(voice_query_file, story_path / "voice_query.wav")
+    # The transcoder leaves the story alone until it's told, see run_story_loop.
+    ctx.playing.add(story_path)
 
+    if prompt is None:
         logging.debug("Reading prompt...")
         prompt = utils.read_from_file(ctx.prompt_file)
 
-        logging.debug("Creating story...")
-        story_stream = await generate_story(ctx, query, prompt)
+    shared_key = ctx.shared_cache.key(ctx, story_path.name, prompt) if ctx.shared_cache else None
+    manifest, story_so_far = await look_up_story(ctx, story_path, shared_key)
+    if manifest:
+        await replay_story(ctx, story_queue, story_path, manifest)
+        return None, story_path
+
+    if story_so_far is not None:
+        for index, paragraph in enumerate(story_so_far):
+            await story_queue.put((story_path, index, paragraph))
+        if utils.is_story_complete(story_path):
+            logging.debug("Read the cached story at %s", story_path)
+            await story_queue.put(None)  # Indicates that we're done
+            return None, story_path
+        logging.info(
+            "Resuming the story at %s after %i paragraphs", story_path, len(story_so_far)
+        )
+    else:
+        story_so_far = []
+        create_story_folder(ctx, story_path, query, query_local)
 
-        index = 0
-        paragraph = []
+    # This file will not exist when the query is passed as an argument
+    if voice_query_file:
+        logging.debug("Copying the original voice query...")
+        shutil.move(voice_query_file, story_path / "voice_query.wav")
 
-        logging.debug("Iterating over the story stream to capture paragraphs...")
-        async for chunk in story_stream:
-            fragment = chunk.choices[0].delta.content
-            if fragment is None:
-                break
+    logging.debug("Creating story...")
+    index = len(story_so_far)
 
-            paragraph.append(fragment)
+    if speculation and not story_so_far:
+        logging.debug("Continuing the speculatively created story...")
+        paragraphs = speculation
+        stats = speculation.stats
+    else:
+        stats = {}
+        paragraphs = stream_paragraphs(ctx, query, prompt, story_so_far, stats)
+
+    # Paragraphs are merged or split into chunks of a size that suits the TTS service.
+    paragraphs = chunking.chunk_paragraphs(
+        paragraphs,
+        ctx.tts_chunk_size,
+        ctx.tts_first_chunk_size if not story_so_far else None,
+    )
 
-            if fragment.endswith("\n\n"):
-                paragraph_str = "".join(paragraph)
-                logging.info("Paragraph %i: %s", index, paragraph_str)
-                utils.write_to_file(
-                    story_path / f"paragraph_{index}.txt", paragraph_str
-                )
-                await story_queue.put((story_path, index, paragraph_str))
-                index += 1
-                paragraph = []
+    logging.debug("Iterating over the story stream to capture paragraphs...")
+    async for paragraph_str in paragraphs:
+        logging.info("Paragraph %i: %s", index, paragraph_str)
+        utils.write_to_file(story_path / f"paragraph_{index}.txt", paragraph_str)
+        await story_queue.put((story_path, index, paragraph_str))
+        index += 1
 
-        logging.debug("Finished processing the story stream.")
-    else:
-        logging.debug("Reading cached story at %s", story_path)
-        for index in range(len(list(story_path.glob("paragraph_*.txt")))):
-            await story_queue.put((story_path, index, None))
+    logging.debug("Finished processing the story stream.")
+    info = utils.read_from_yaml(story_path / "info.yaml")
+    info.update(stats)
+    utils.write_to_yaml(story_path / "info.yaml", info)
+    utils.mark_story_complete(story_path)
 
     logging.debug("Done processing the story.")
     await story_queue.put(None)  # Indicates that we're done
 
+    # Newly generated stories are shared once the reader has synthesized their audio.
+    return shared_key, story_path
+
 
-async def reader(ctx, story_queue, reading_queue):
+async def reader(ctx, story_queue, reading_queue, scheduler):
     """
     Processes the queue of paragraphs and sends them off to be read
     and synthezized into audio files to be read by the speaker.
+
+    Paragraphs are synthesized concurrently, as far ahead of the one being
+    played as the lookahead scheduler decides.
     """
+
+    async def timed_synthesis(story_path, index, paragraph):
+        start_time = time.monotonic()
+        audio_file = await synthesize_audio(ctx, story_path, index, paragraph)
+        await scheduler.record_synthesis(time.monotonic() - start_time)
+        return audio_file
+
     while ctx.talking:
         item = await story_queue.get()
         if item is None:
@@ -185,59 +623,120 @@ async def reader(ctx, story_queue, reading_queue):
 
         story_path, index, paragraph = item
 
-        audio_file = await synthesize_audio(ctx, story_path, index, paragraph)
-        await reading_queue.put(audio_file)
+        if not await scheduler.wait_for_turn(index):
+            break
 
+        synthesis = asyncio.create_task(timed_synthesis(story_path, index, paragraph))
+        await reading_queue.put((index, synthesis))
 
-async def speaker(ctx, reading_queue):
+
+async def speaker(ctx, reading_queue, scheduler):
     """
     Processes the queue of audio files and plays them.
     """
     loop = asyncio.get_running_loop()
     with concurrent.futures.ThreadPoolExecutor() as pool:
         while ctx.talking:
-            audio_file = await reading_queue.get()
-            if audio_file is None:
+            item = await reading_queue.get()
+            if item is None:
                 logging.debug("Done playing the story.")
                 break
 
+            index, synthesis = item
+            audio_file = await synthesis
+
             def speak():
                 ctx.leds.stop()
                 utils.play_audio_file(audio_file, ctx.sound_driver)
 
+            await scheduler.start_playing(index)
+            start_time = time.monotonic()
             await loop.run_in_executor(pool, speak)
+            await scheduler.record_playback(time.monotonic() - start_time)
 
+    await scheduler.stop()
 
-async def run_story_loop(ctx, query=None, terminate=False):
+    # Don't synthesize paragraphs nobody is going to hear.
+    while not reading_queue.empty():
+        item = reading_queue.get_nowait()
+        if item is not None:
+            item[1].cancel()
+
+
+async def run_story_loop(ctx, query=None, terminate=False, preroll=None):
     """
     The main loop for running the story.
     """
     ctx.talking = True
     ctx.leds.start()
 
+    # Voice queries take a while to say, long enough to get the services ready for them.
+    warm_up_task = asyncio.create_task(warmup.warm_up(ctx)) if not query else None
+
     story_queue = asyncio.Queue()
     reading_queue = asyncio.Queue()
+    scheduler = LookaheadScheduler(ctx.max_tts_lookahead)
 
-    writer_task = asyncio.create_task(writer(ctx, story_queue, query))
-    reader_task = asyncio.create_task(reader(ctx, story_queue, reading_queue))
-    speaker_task = asyncio.create_task(speaker(ctx, reading_queue))
+    writer_task = asyncio.create_task(writer(ctx, story_queue, query, preroll))
+    reader_task = asyncio.create_task(
+        reader(ctx, story_queue, reading_queue, scheduler)
+    )
+    speaker_task = asyncio.create_task(speaker(ctx, reading_queue, scheduler))
 
-    await asyncio.gather(writer_task, reader_task, speaker_task)
+    try:
+        (shared_key, story_path), _, _ = await asyncio.gather(
+            writer_task, reader_task, speaker_task
+        )
+    finally:
+        # Whatever went wrong, the next press of the button has to start a new story.
+        if warm_up_task:
+            warm_up_task.cancel()
+        ctx.leds.stop()
+        ctx.talking = False
+
+    ctx.playing.discard(story_path)
+    if shared_key:
+        # The story is left alone by the transcoder until it's uploaded.
+        ctx.uploading.add(story_path)
+
+        def upload():
+            try:
+                ctx.shared_cache.upload(shared_key, story_path)
+            finally:
+                ctx.uploading.discard(story_path)
+                ctx.stories_changed.set()
+
+        threading.Thread(target=upload).start()
 
-    ctx.leds.stop()
-    ctx.talking = False
+    ctx.stories_changed.set()
 
     if terminate:
         ctx.running = False
 
 
-def tell_story(ctx, query=None, terminate=False):
+def maintain_cache(ctx):
+    """
+    Keep transcoding and rendering the cached stories in the background,
+    going over them again each time a story was told.
+    """
+    while ctx.running:
+        transcode.transcode_stories(ctx)
+        if ctx.render_stories:
+            render.render_stories(ctx)
+
+        # Wait for the next story to be told, checking every now and then whether we're shutting down.
+        while ctx.running and not ctx.stories_changed.wait(transcode.IDLE_WAIT):
+            pass
+        ctx.stories_changed.clear()
+
+
+def tell_story(ctx, query=None, terminate=False, preroll=None):
     """
     Forks off a thread to tell the story.
     """
 
     def tell_story_wrapper():
-        asyncio.run(run_story_loop(ctx, query, terminate))
+        asyncio.run(run_story_loop(ctx, query, terminate, preroll))
 
     threading.Thread(target=tell_story_wrapper).start()
 
@@ -247,13 +746,27 @@ def main(ctx, query=None):
     The main Fably loop.
     """
 
-    ctx.stt_client = openai.Client(base_url=ctx.stt_url, api_key=ctx.api_key, )
-    ctx.llm_client = openai.AsyncClient(base_url=ctx.llm_url, api_key=ctx.api_key)
-    ctx.tts_client = openai.AsyncClient(base_url=ctx.tts_url, api_key=ctx.api_key)
+    if ctx.shared_cache_url:
+        ctx.shared_cache = SharedStoryCache(ctx.shared_cache_url)
+
+    utils.migrate_legacy_stories(ctx.stories_path)
+
+    if ollama.endpoints(ctx):
+        threading.Thread(target=ollama.keep_models_loaded, args=(ctx,), daemon=True).start()
+
+    if ctx.audio_cache_format != "original" or ctx.render_stories:
+        threading.Thread(target=maintain_cache, args=(ctx,), daemon=True).start()
 
     # If a query is not present, introduce ourselves
     if not query:
-        ctx.recognizer = utils.get_speech_recognizer(ctx.models_path, ctx.sound_model)
+        ctx.speech_model = utils.get_speech_model(ctx.models_path, ctx.sound_model)
+        ctx.recognizer = utils.speech_recognizer(ctx.speech_model)
+
+        # Calibrate before making any sound ourselves, so that we only hear the room.
+        if ctx.silence_threshold is None:
+            ctx.silence_threshold = audio_analysis.calibrate_silence_threshold(
+                utils.QUERY_SAMPLE_RATE
+            )
 
     if ctx.loop and Button:
         ctx.leds.start()
@@ -295,11 +808,18 @@ def main(ctx, query=None):
 
         # Stop the LEDs once we're ready.
         ctx.leds.stop()
-    else:
+    elif not (ctx.wake_phrase and not query):
         # Here the query can be None, but it's ok.
         # We will record one from the user in that case.
         tell_story(ctx, query=query, terminate=True)
 
+    if ctx.wake_phrase and not query:
+        threading.Thread(
+            target=wake.listen_for_wake_phrase,
+            args=(ctx, lambda preroll: tell_story(ctx, preroll=preroll)),
+            daemon=True,
+        ).start()
+
     # Keep the main thread from existing until we're done.
     while ctx.running:
         time.sleep(1.0)
@@ -0,0 +1,129 @@
+"""
+Tail latency control for the calls to the LLM and TTS services.
+
+A single slow request is heard as silence by the child. Requests are hedged: when a request takes longer
+than the 95th percentile of the recent latencies of its stage (or a configured deadline until there are
+enough of them), a duplicate is sent, possibly to an alternate endpoint, the first response wins and
+the other request is cancelled.
+
+Requests can also be raced: they are sent to several endpoints at once and the first to respond wins.
+"""
+
+import asyncio
+import collections
+import logging
+import math
+import time
+
+WINDOW = 50
+MIN_SAMPLES = 10
+PERCENTILE = 0.95
+
+
+class LatencyTracker:
+    """
+    Keeps the recent latencies of a stage and derives the deadline after which its requests are hedged.
+    """
+
+    def __init__(self, name, deadline, window=WINDOW):
+        self.name = name
+        self.deadline = deadline
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, seconds):
+        """
+        Record the latency of a request.
+        """
+        self.latencies.append(seconds)
+
+    def hedge_after(self):
+        """
+        Return how many seconds to wait for a request before sending a duplicate.
+
+        This is the configured deadline until there are enough samples to estimate the 95th percentile,
+        which is never exceeded either. An infinite deadline turns hedging off.
+        """
+        if len(self.latencies) < MIN_SAMPLES or math.isinf(self.deadline):
+            return self.deadline
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(PERCENTILE * len(latencies)))]
+        return min(p95, self.deadline)
+
+
+async def hedged(request, tracker, discard=None):
+    """
+    Run the request returned by calling request(attempt), hedging it with a second attempt
+    if it doesn't complete within the deadline of the given tracker.
+
+    Returns the result of the first attempt that succeeds. If both succeed at once, the result
+    of the loser is passed to the discard coroutine function, if any, to release it.
+    """
+    start_time = time.monotonic()
+    attempts = [asyncio.create_task(request(0))]
+    done, pending = await asyncio.wait(attempts, timeout=tracker.hedge_after())
+    if not done:
+        logging.debug(
+            "%s request took longer than %.2fs, hedging it",
+            tracker.name,
+            tracker.hedge_after(),
+        )
+        attempts.append(asyncio.create_task(request(1)))
+
+    try:
+        while True:
+            done, pending = await asyncio.wait(
+                attempts, return_when=asyncio.FIRST_COMPLETED
+            )
+            winners = [attempt for attempt in done if not attempt.exception()]
+            if winners or not pending:
+                break
+            # An attempt failed, give the other one a chance.
+            attempts = list(pending)
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+    if not winners:
+        raise done.pop().exception()
+
+    winner = winners[0]
+    if discard:
+        for loser in winners[1:]:
+            await discard(loser.result())
+
+    tracker.record(time.monotonic() - start_time)
+    return winner.result()
+
+
+async def race(requests, discard=None):
+    """
+    Run all the given request coroutines at once and return the result of the first one that succeeds,
+    cancelling the others. The results of the ones that succeeded at the same time are passed to
+    the discard coroutine function, if any, to release them.
+
+    Returns the index of the winning request along with its result.
+    """
+    attempts = [asyncio.create_task(request) for request in requests]
+    pending = set(attempts)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winners = [attempt for attempt in done if not attempt.exception()]
+            if winners:
+                break
+    finally:
+        for attempt in pending:
+            attempt.cancel()
+
+    if not winners:
+        raise done.pop().exception()
+
+    winner = min(winners, key=attempts.index)
+    if discard:
+        for loser in winners:
+            if loser is not winner:
+                await discard(loser.result())
+
+    return attempts.index(winner), winner.result()
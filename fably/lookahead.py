@@ -0,0 +1,100 @@
+"""
+Adaptive scheduling of the paragraphs synthesized ahead of the one being played.
+
+Synthesizing too few paragraphs ahead leaves gaps whenever the TTS service is slower than playback,
+synthesizing too many wastes TTS quota on paragraphs nobody hears when a story is interrupted. The
+scheduler measures, while the story is playing, how long paragraphs take to synthesize and to play
+and keeps just enough paragraphs in flight for the playback queue to never run dry.
+"""
+
+import asyncio
+import logging
+import math
+
+INITIAL_LOOKAHEAD = 2
+MAX_LOOKAHEAD = 4
+SAFETY_MARGIN = 1.5
+SMOOTHING = 0.5
+
+
+def moving_average(average, value, smoothing=SMOOTHING):
+    """
+    Return the exponential moving average updated with the given value.
+    """
+    return value if average is None else smoothing * value + (1 - smoothing) * average
+
+
+class LookaheadScheduler:
+    """
+    Decides how many paragraphs the reader synthesizes ahead of the one the speaker is playing.
+    """
+
+    def __init__(self, max_lookahead=MAX_LOOKAHEAD, initial_lookahead=INITIAL_LOOKAHEAD):
+        self.max_lookahead = max_lookahead
+        self.initial_lookahead = min(initial_lookahead, max_lookahead)
+        self.synthesis_time = None
+        self.playback_time = None
+        self.playing = -1
+        self.stopped = False
+        self.condition = asyncio.Condition()
+
+    def lookahead(self):
+        """
+        Return the number of paragraphs to synthesize ahead of the one being played.
+
+        Each paragraph has to be ready by the time the previous one finishes playing, so with
+        synthesis S times slower than playback, S paragraphs (plus some margin) have to be in flight.
+        """
+        if self.synthesis_time is None or not self.playback_time:
+            return self.initial_lookahead
+        needed = math.ceil(SAFETY_MARGIN * self.synthesis_time / self.playback_time)
+        return max(1, min(needed, self.max_lookahead))
+
+    async def wait_for_turn(self, index):
+        """
+        Wait until the given paragraph should be synthesized. Returns False if the story was stopped.
+        """
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.stopped or index <= self.playing + self.lookahead()
+            )
+            if not self.stopped:
+                logging.debug(
+                    "Synthesizing paragraph %i while playing paragraph %i (lookahead %i)",
+                    index,
+                    self.playing,
+                    self.lookahead(),
+                )
+            return not self.stopped
+
+    async def _notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def record_synthesis(self, seconds):
+        """
+        Record how long it took to synthesize a paragraph.
+        """
+        self.synthesis_time = moving_average(self.synthesis_time, seconds)
+        await self._notify()
+
+    async def record_playback(self, seconds):
+        """
+        Record how long it took to play a paragraph.
+        """
+        self.playback_time = moving_average(self.playback_time, seconds)
+        await self._notify()
+
+    async def start_playing(self, index):
+        """
+        Record that the given paragraph started playing.
+        """
+        self.playing = index
+        await self._notify()
+
+    async def stop(self):
+        """
+        Stop scheduling paragraphs, the story is over.
+        """
+        self.stopped = True
+        await self._notify()
@@ -0,0 +1,149 @@
+"""
+Residency management of the models of local Ollama servers.
+
+Ollama unloads the models that haven't been used for a while, and loading one back into RAM can take
+longer than generating a story. Models are loaded when Fably starts and, during the hours Fably is used,
+kept loaded until the end of them: requests ask Ollama to keep the model around until then and the model
+is pinged every now and then in case it was unloaded anyway, e.g. because the server restarted. Outside of
+those hours, models are only kept for a while after each story.
+"""
+
+import datetime
+import logging
+import time
+
+from urllib.parse import urlparse
+
+import requests
+
+OLLAMA_PORT = 11434
+KEEP_ALIVE = "10m"
+PING_INTERVAL = 300
+REQUEST_TIMEOUT = 60
+# Checking whether a model is loaded happens while the story waits, it's not worth waiting for long.
+STATUS_TIMEOUT = 1.0
+
+
+def is_ollama(url):
+    """
+    Check whether the given URL is the one of an Ollama server, which listens on its own port.
+    """
+    return urlparse(str(url)).port == OLLAMA_PORT
+
+
+def api_url(url, endpoint):
+    """
+    Return the URL of the given endpoint of the native API of the Ollama server with the given
+    OpenAI compatible URL.
+    """
+    parsed = urlparse(str(url))
+    return f"{parsed.scheme}://{parsed.netloc}/api/{endpoint}"
+
+
+def endpoints(ctx):
+    """
+    Return the (model, url) pairs of the LLM endpoints served by Ollama.
+    """
+    llm_endpoints = [(ctx.llm_model, ctx.llm_url)] + list(ctx.llm_race)
+    if ctx.llm_hedge_url:
+        llm_endpoints.append((ctx.llm_model, ctx.llm_hedge_url))
+    return [endpoint for endpoint in dict.fromkeys(llm_endpoints) if is_ollama(endpoint[1])]
+
+
+def parse_usage_hours(value):
+    """
+    Parse usage hours given as START-END, in hours of the day, into a (start, end) pair.
+
+    The end can be before the start for usage hours that span midnight.
+    """
+    start, _, end = value.partition("-")
+    try:
+        hours = int(start), int(end)
+    except ValueError:
+        raise ValueError(f'"{value}" is not in the START-END form.') from None
+    if not all(0 <= hour <= 24 for hour in hours):
+        raise ValueError(f'"{value}" has hours outside of the day.')
+    return hours
+
+
+def seconds_left_in_usage_hours(usage_hours, now=None):
+    """
+    Return the number of seconds until the end of the given usage hours, or 0 if we're outside of them.
+    """
+    now = now or datetime.datetime.now()
+    start, end = usage_hours
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    hour = now.hour + now.minute / 60 + now.second / 3600
+
+    if start <= end:
+        if not start <= hour < end:
+            return 0
+    elif end <= hour < start:
+        return 0
+    elif hour >= start:
+        midnight += datetime.timedelta(days=1)
+
+    return int((midnight + datetime.timedelta(hours=end) - now).total_seconds())
+
+
+def keep_alive(ctx):
+    """
+    Return how long Ollama should keep the model loaded after a request, in its duration format.
+    """
+    if ctx.llm_usage_hours:
+        seconds = seconds_left_in_usage_hours(ctx.llm_usage_hours)
+        if seconds:
+            return f"{seconds}s"
+    return ctx.llm_keep_alive
+
+
+def preload_model(url, model, keep_alive_duration=KEEP_ALIVE):
+    """
+    Ask the Ollama server at the given URL to load the given model and keep it loaded for the given time.
+    """
+    try:
+        response = requests.post(
+            api_url(url, "generate"),
+            json={"model": model, "keep_alive": keep_alive_duration},
+            timeout=REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        logging.debug("Loaded %s on %s for %s", model, url, keep_alive_duration)
+    except requests.RequestException as e:
+        logging.debug("Failed to load %s on %s: %s", model, url, e)
+
+
+def is_model_loaded(url, model):
+    """
+    Check whether the given model is loaded on the Ollama server at the given URL.
+
+    Returns None if the server can't tell.
+    """
+    try:
+        response = requests.get(api_url(url, "ps"), timeout=STATUS_TIMEOUT)
+        response.raise_for_status()
+        names = {entry["name"] for entry in response.json().get("models", [])}
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logging.debug("Failed to list the models loaded on %s: %s", url, e)
+        return None
+    # Models without a tag are the latest ones.
+    return model in names or f"{model}:latest" in names
+
+
+def keep_models_loaded(ctx):
+    """
+    Load the models of the LLM endpoints served by Ollama, then keep pinging them during usage hours
+    so that they stay loaded, until Fably shuts down.
+    """
+    for model, url in endpoints(ctx):
+        preload_model(url, model, keep_alive(ctx))
+
+    last_ping = time.monotonic()
+    while ctx.running:
+        time.sleep(1.0)
+        if time.monotonic() - last_ping < PING_INTERVAL:
+            continue
+        last_ping = time.monotonic()
+        if ctx.llm_usage_hours and seconds_left_in_usage_hours(ctx.llm_usage_hours):
+            for model, url in endpoints(ctx):
+                preload_model(url, model, keep_alive(ctx))
@@ -0,0 +1,367 @@
+"""
+Rendering of whole stories into a single continuous audio file.
+
+Once all the paragraphs of a story have their audio, it is rendered in the background into a story file
+next to them, along with the offset of each paragraph in it so that playback can still start at any
+paragraph. Replaying a rendered story then plays a single file.
+
+MP3 paragraphs are rendered into an MP3 story by copying their frames as they are, one paragraph at a time.
+Anything else is decoded and encoded in a single streaming pass. Either way, memory use is bounded by a
+paragraph or a block of samples whatever the length of the story.
+"""
+
+import logging
+import os
+import re
+
+from pathlib import Path
+
+import soundfile as sf
+
+from fably import transcode
+from fably import utils
+
+BLOCK_SIZE = 65536
+STORY_INDEX = "story.yaml"
+PARAGRAPH_AUDIO = re.compile(r"^paragraph_(\d+)\.(mp3|wav|ogg|opus|flac)$")
+
+# The soundfile format and subtype of each story format.
+SOUNDFILE_FORMATS = {
+    "mp3": ("MP3", "MPEG_LAYER_III"),
+    "wav": ("WAV", "PCM_16"),
+    "flac": ("FLAC", "PCM_16"),
+    "ogg": ("OGG", "VORBIS"),
+    "opus": ("OGG", "OPUS"),
+}
+
+# MPEG audio layer III bitrates (kbps) by bitrate index, for MPEG 1 and for MPEG 2 and 2.5.
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# MPEG audio sample rates by version bits and sample rate index.
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+MP3_INFO_TAGS = (b"Xing", b"Info", b"VBRI")
+MP3_ENCODER_TAGS = (b"LAME", b"Lavf", b"Lavc")
+
+
+def paragraph_audio_files(story_path):
+    """
+    Return the audio files of the paragraphs of the story at the given path, in paragraph order.
+    """
+    paragraphs = {}
+    for entry in os.scandir(story_path):
+        match = PARAGRAPH_AUDIO.match(entry.name)
+        if match:
+            paragraphs.setdefault(int(match.group(1)), Path(entry.path))
+    return [paragraphs[index] for index in sorted(paragraphs)]
+
+
+def mp3_frame_length(data, offset):
+    """
+    Return the length of the MPEG audio layer III frame starting at the given offset, or None if there is none.
+    """
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 0x03
+    layer = (data[offset + 1] >> 1) & 0x03
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0x03
+    padding = (data[offset + 2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+
+def mp3_frame_duration(frame):
+    """
+    Return the duration in seconds of the given MPEG audio layer III frame.
+    """
+    version = (frame[1] >> 3) & 0x03
+    sample_rate = MP3_SAMPLE_RATES[version][(frame[2] >> 2) & 0x03]
+    return (1152 if version == 3 else 576) / sample_rate
+
+
+def mp3_frames(data):
+    """
+    Split the given MP3 data into its VBR info frame, if any, and its audio frames, leaving out the ID3 tags.
+
+    There are no audio frames if the data can't be parsed.
+    """
+    start, end = 0, len(data)
+    if data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        start = 10 + size + (10 if data[5] & 0x10 else 0)
+    if end - start >= 128 and data[end - 128 : end - 125] == b"TAG":
+        end -= 128
+
+    offset = start
+    info = None
+    frames = []
+    while offset < end:
+        length = mp3_frame_length(data, offset)
+        if length is None:
+            break
+        frame = data[offset : min(offset + length, end)]
+        # The data can be a view into a bundle, which can't be searched.
+        if offset == start and any(tag in bytes(frame[:64]) for tag in MP3_INFO_TAGS):
+            info = bytes(frame)
+        else:
+            frames.append(frame)
+        offset += length
+
+    return info, frames
+
+
+def crc16(data):
+    """
+    Return the CRC-16 (as used by the LAME tag) of the given data.
+    """
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def update_info_frame(info, frame_count, byte_count, padding=None):
+    """
+    Return the given Xing/Info frame updated to describe a stream of the given number of audio frames and bytes,
+    or None if it's not one. Without it, decoders would take the concatenated story for its first paragraph.
+    """
+    frame = bytearray(info)
+    tag = max(frame.find(b"Xing"), frame.find(b"Info"))
+    if tag < 0:
+        return None
+
+    flags = int.from_bytes(frame[tag + 4 : tag + 8], "big")
+    position = tag + 8
+    if flags & 0x01:
+        frame[position : position + 4] = frame_count.to_bytes(4, "big")
+        position += 4
+    if flags & 0x02:
+        frame[position : position + 4] = byte_count.to_bytes(4, "big")
+        position += 4
+    if flags & 0x04:
+        # A linear seek table, good enough for streams that are mostly speech.
+        frame[position : position + 100] = bytes(i * 256 // 100 for i in range(100))
+        position += 100
+    if flags & 0x08:
+        position += 4
+
+    if bytes(frame[position : position + 4]) in MP3_ENCODER_TAGS:
+        if padding is not None:
+            delay = int.from_bytes(frame[position + 21 : position + 24], "big") >> 12
+            frame[position + 21 : position + 24] = ((delay << 12) | padding).to_bytes(3, "big")
+        frame[position + 28 : position + 32] = byte_count.to_bytes(4, "big")
+        frame[position + 34 : position + 36] = crc16(frame[: position + 34]).to_bytes(2, "big")
+
+    return bytes(frame)
+
+
+def end_padding(info):
+    """
+    Return the number of padding samples at the end of the stream described by the given info frame, if known.
+    """
+    position = max(info.find(b"Xing"), info.find(b"Info"))
+    if position < 0:
+        return None
+    flags = int.from_bytes(info[position + 4 : position + 8], "big")
+    position += 8 + 4 * bin(flags & 0x0B).count("1") + (100 if flags & 0x04 else 0)
+    if info[position : position + 4] not in MP3_ENCODER_TAGS:
+        return None
+    return int.from_bytes(info[position + 21 : position + 24], "big") & 0xFFF
+
+
+def joined_info_frame(info, last_info, frame_count, byte_count):
+    """
+    Return the info frame of the first of several joined MP3 streams updated to describe all of them,
+    given the info frame of the last one, if any, and their total number of audio frames and bytes.
+    """
+    padding = end_padding(last_info) if last_info else None
+    updated = update_info_frame(info, frame_count, len(info) + byte_count, padding)
+    # Other kinds of info frames are replaced by silence since they can't be updated.
+    return updated or info[:4] + bytes(len(info) - 4)
+
+
+def join_mp3_frames(streams):
+    """
+    Join the audio frames of the given MP3 streams, keeping the info frame of the first one, if any,
+    updated to describe the joined stream. Without it, decoders would stop at the end of the first stream.
+
+    Returns the info frame and the audio frames of each stream, which are empty if any of them can't be parsed.
+    """
+    parsed = [mp3_frames(data) for data in streams]
+    if not parsed or not all(frames for _, frames in parsed):
+        return None, []
+
+    info, last_info = parsed[0][0], parsed[-1][0]
+    frames = [frames for _, frames in parsed]
+    if info:
+        frame_count = sum(len(stream_frames) for stream_frames in frames)
+        byte_count = sum(len(frame) for stream_frames in frames for frame in stream_frames)
+        info = joined_info_frame(info, last_info, frame_count, byte_count)
+
+    return info, frames
+
+
+def concat_mp3_frames(audio_files, output_file):
+    """
+    Concatenate the given MP3 files by copying their frames, one file at a time.
+
+    The info frame of the first file is kept and updated to describe the whole story, which takes a first
+    pass over the files to count their frames.
+
+    Returns the duration of each file, or None if any of them can't be parsed.
+    """
+    info = last_info = None
+    frame_count = byte_count = 0
+    durations = []
+    for audio_file in audio_files:
+        last_info, frames = mp3_frames(audio_file.read_bytes())
+        if not frames:
+            return None
+        info = info if durations else last_info
+        frame_count += len(frames)
+        byte_count += sum(len(frame) for frame in frames)
+        durations.append(len(frames) * mp3_frame_duration(frames[0]))
+
+    with open(output_file, "wb") as output:
+        if info:
+            output.write(joined_info_frame(info, last_info, frame_count, byte_count))
+        for audio_file in audio_files:
+            _, frames = mp3_frames(audio_file.read_bytes())
+            output.writelines(frames)
+
+    return durations
+
+
+def concat_transcoding(audio_files, output_file, output_format):
+    """
+    Concatenate the given audio files by decoding them and encoding the result in a single streaming pass.
+
+    Returns the duration of each file.
+    """
+    durations = []
+    file_format, subtype = SOUNDFILE_FORMATS[output_format]
+    with sf.SoundFile(audio_files[0]) as first:
+        sample_rate, channels = first.samplerate, first.channels
+
+    with sf.SoundFile(
+        output_file, "w", sample_rate, channels, subtype, format=file_format
+    ) as output:
+        for audio_file in audio_files:
+            with sf.SoundFile(audio_file) as audio:
+                if (audio.samplerate, audio.channels) != (sample_rate, channels):
+                    raise ValueError(
+                        f"{audio_file} is {audio.samplerate}Hz with {audio.channels} channels "
+                        f"while the story is {sample_rate}Hz with {channels} channels"
+                    )
+                for block in audio.blocks(blocksize=BLOCK_SIZE, dtype="float32"):
+                    output.write(block)
+                durations.append(audio.frames / sample_rate)
+
+    return durations
+
+
+def story_format(audio_files):
+    """
+    Return the format to render a story with the given paragraph audio files in: the format of the
+    paragraphs when they all share one, uncompressed WAV otherwise.
+    """
+    formats = {audio_file.suffix[1:] for audio_file in audio_files}
+    audio_format = formats.pop() if len(formats) == 1 else "wav"
+    return audio_format if audio_format in SOUNDFILE_FORMATS else "wav"
+
+
+def rendered_story(story_path):
+    """
+    Return the rendered audio file of the story at the given path along with the offset in seconds
+    of each paragraph in it, or None if the story wasn't rendered or changed since.
+    """
+    index_file = story_path / STORY_INDEX
+    if not index_file.exists():
+        return None
+
+    index = utils.read_from_yaml(index_file)
+    audio_file = story_path / index["audio"]
+    audio_files = paragraph_audio_files(story_path)
+    if (
+        not audio_file.exists()
+        or len(audio_files) != len(index["paragraphs"])
+        or index_file.stat().st_mtime < max(f.stat().st_mtime for f in audio_files)
+    ):
+        return None
+
+    return audio_file, index["paragraphs"]
+
+
+def render_story(story_path, output_format=None, force=False):
+    """
+    Render the paragraph audio of the story at the given path into a single file, unless it's up to date.
+
+    Returns a message describing what was done, or None if the path doesn't contain a story.
+    """
+    audio_files = paragraph_audio_files(story_path)
+    if not audio_files:
+        return None
+
+    output_format = output_format or story_format(audio_files)
+    output_file = story_path / f"story.{output_format}"
+    rendered = rendered_story(story_path)
+    if not force and rendered and rendered[0] == output_file:
+        return f"Skipping {story_path}, {output_file} is up to date."
+
+    # The story might have been rendered in another format before, e.g. before its paragraphs were transcoded.
+    index_file = story_path / STORY_INDEX
+    previous_file = None
+    if index_file.exists():
+        previous_file = story_path / utils.read_from_yaml(index_file)["audio"]
+
+    # Write to a temporary file first so that an interruption never leaves a truncated story behind.
+    tmp_file = utils.temporary_path(output_file)
+    copied = output_format == "mp3" and all(f.suffix == ".mp3" for f in audio_files)
+    durations = concat_mp3_frames(audio_files, tmp_file) if copied else None
+    if durations is None:
+        copied = False
+        durations = concat_transcoding(audio_files, tmp_file, output_format)
+    tmp_file.replace(output_file)
+
+    offsets = [sum(durations[:index]) for index in range(len(durations))]
+    utils.write_to_yaml(index_file, {"audio": output_file.name, "paragraphs": offsets})
+    if previous_file and previous_file != output_file:
+        previous_file.unlink(missing_ok=True)
+
+    method = "copying frames" if copied else "transcoding"
+    return f"Rendered {len(audio_files)} paragraphs into {output_file} by {method}."
+
+
+def render_stories(ctx):
+    """
+    Render all the complete cached stories whose paragraphs all have audio,
+    one at a time and only while no story is being told, leaving alone the ones in use.
+    """
+    for story_path in sorted(ctx.stories_path.iterdir()):
+        if not story_path.is_dir() or not utils.is_story_complete(story_path):
+            continue
+        if len(paragraph_audio_files(story_path)) != utils.count_paragraphs(story_path):
+            continue
+
+        if not transcode.wait_until_idle(ctx):
+            return
+        if transcode.is_in_use(ctx, story_path):
+            continue
+
+        try:
+            message = render_story(story_path)
+            logging.debug(message)
+        except (sf.LibsndfileError, RuntimeError, ValueError, OSError) as e:
+            logging.warning("Failed to render %s: %s", story_path, e)
@@ -0,0 +1,163 @@
+"""
+Fast path to replay cached stories.
+
+A cached story with the audio of all its paragraphs doesn't need any of the writer, reader and speaker
+machinery: its manifest is read once, checked for completeness and all the audio is streamed into a single
+audio output so that there are no gaps between paragraphs. Stories rendered into a single audio file are
+played from that file.
+"""
+
+import io
+import logging
+import os
+import re
+import subprocess
+
+from pathlib import Path
+
+import numpy as np
+import sounddevice as sd
+import soundfile as sf
+
+from fably import bundle
+from fably import render
+from fably import utils
+
+BLOCK_SIZE = 4096
+PARAGRAPH_TEXT = re.compile(r"^paragraph_(\d+)\.txt$")
+
+
+def _bundle_manifest(bundle_file, paragraph):
+    story = bundle.StoryBundle(bundle_file)
+    return [(story.audio(index), story.audio_format, 0) for index in range(paragraph, len(story))]
+
+
+def _directory_manifest(story_path, names, paragraph):
+    paragraphs = len([name for name in names if PARAGRAPH_TEXT.match(name)])
+    if not paragraphs:
+        return None
+
+    rendered = render.rendered_story(story_path)
+    if rendered:
+        audio_file, offsets = rendered
+        return [(audio_file, audio_file.suffix[1:], offsets[paragraph])]
+
+    manifest = []
+    for index in range(paragraph, paragraphs):
+        audio_formats = [
+            audio_format
+            for audio_format in utils.AUDIO_FORMATS
+            if f"paragraph_{index}.{audio_format}" in names
+        ]
+        if not audio_formats:
+            logging.debug("Paragraph %i of %s has no audio yet", index, story_path)
+            return None
+        manifest.append(
+            (story_path / f"paragraph_{index}.{audio_formats[0]}", audio_formats[0], 0)
+        )
+
+    return manifest
+
+
+def read_manifest(story_path, paragraph=0):
+    """
+    Return the audio to play the story at the given path from the given paragraph on, as
+    (source, format, start) tuples where source is either a file path or the encoded audio data
+    and start the offset in seconds to start playing it at, or None if the story is not complete.
+    """
+    bundle_file = bundle.bundle_path(story_path)
+    if bundle_file.exists():
+        return _bundle_manifest(bundle_file, paragraph)
+
+    if not story_path.is_dir():
+        return None
+
+    # A single directory listing tells us everything we need.
+    names = {entry.name for entry in os.scandir(story_path)}
+    if utils.STORY_COMPLETE_MARKER not in names:
+        logging.debug("Story at %s was not completely generated", story_path)
+        return None
+
+    return _directory_manifest(story_path, names, paragraph)
+
+
+def _open(source, start=0):
+    audio = sf.SoundFile(source if isinstance(source, Path) else io.BytesIO(source))
+    if start:
+        audio.seek(int(start * audio.samplerate))
+    return audio
+
+
+def _read_mp3_stream(manifest):
+    data = [source.read_bytes() if isinstance(source, Path) else source for source, _, _ in manifest]
+    # Each file starts with an info frame giving its length: mpg123 would take the first one
+    # for the length of the whole stream and stop at the end of the first file.
+    info, frames = render.join_mp3_frames(data)
+    if frames:
+        data = [info or b""] + [b"".join(stream_frames) for stream_frames in frames]
+    for stream in data:
+        for offset in range(0, len(stream), BLOCK_SIZE * 16):
+            yield stream[offset : offset + BLOCK_SIZE * 16]
+
+
+def _play_with_sounddevice(ctx, manifest):
+    stream = None
+    try:
+        for source, _, start in manifest:
+            with _open(source, start) as audio:
+                if stream is None:
+                    stream = sd.OutputStream(
+                        samplerate=audio.samplerate,
+                        channels=audio.channels,
+                        dtype="float32",
+                    )
+                    stream.start()
+                for block in audio.blocks(blocksize=BLOCK_SIZE, dtype="float32"):
+                    if not ctx.talking:
+                        return
+                    stream.write(block)
+    finally:
+        if stream is not None:
+            stream.stop()
+            stream.close()
+
+
+def _play_with_alsa(ctx, manifest):
+    if all(audio_format == "mp3" and not start for _, audio_format, start in manifest):
+        # The frames of MP3 streams can be concatenated and mpg123 plays them back to back without gaps.
+        with subprocess.Popen(["mpg123", "-q", "-"], stdin=subprocess.PIPE) as process:
+            for block in _read_mp3_stream(manifest):
+                if not ctx.talking:
+                    break
+                process.stdin.write(block)
+            process.stdin.close()
+        return
+
+    # Anything else is decoded here and streamed as raw samples into a single aplay.
+    with _open(manifest[0][0]) as audio:
+        sample_rate, channels = audio.samplerate, audio.channels
+    player = ["aplay", "-q", "-t", "raw", "-f", "S16_LE"]
+    player += ["-r", str(sample_rate), "-c", str(channels), "-"]
+    with subprocess.Popen(player, stdin=subprocess.PIPE) as process:
+        for source, _, start in manifest:
+            with _open(source, start) as audio:
+                for block in audio.blocks(blocksize=BLOCK_SIZE, dtype="int16"):
+                    if not ctx.talking:
+                        break
+                    process.stdin.write(np.ascontiguousarray(block).tobytes())
+        process.stdin.close()
+
+
+def play_story(ctx, manifest):
+    """
+    Play the audio of all the paragraphs in the manifest back to back, stopping if the story is interrupted.
+    """
+    logging.debug("Replaying %i paragraphs with %s", len(manifest), ctx.sound_driver)
+    ctx.leds.stop()
+    if ctx.sound_driver == "sounddevice":
+        _play_with_sounddevice(ctx, manifest)
+    elif ctx.sound_driver == "alsa":
+        _play_with_alsa(ctx, manifest)
+    else:
+        raise ValueError(f"Unsupported audio driver: {ctx.sound_driver}")
+    logging.debug("Done replaying the story.")
@@ -0,0 +1,118 @@
+"""
+Client for the story cache server shared by a fleet of Fably devices.
+"""
+
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+
+from pathlib import Path
+
+import requests
+
+from fably import utils
+
+TIMEOUT = 10
+
+
+class SharedStoryCache:
+    """
+    Looks up stories generated by any device on the shared story cache server
+    and uploads the ones generated locally.
+    """
+
+    def __init__(self, url, timeout=TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def key(self, ctx, query, prompt):
+        """
+        Return the key of a story on the shared cache.
+
+        The key covers the normalized query and everything else that affects the story text and audio,
+        so that devices with different settings don't share stories.
+        """
+        params = {
+            "query": query,
+            "prompt": prompt,
+            "language": ctx.language,
+            "llm_model": ctx.llm_model,
+            "llm_temperature": ctx.temperature,
+            "llm_max_tokens": ctx.max_tokens,
+            "tts_model": ctx.tts_model,
+            "tts_voice": ctx.tts_voice,
+            "tts_format": ctx.tts_format,
+        }
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()
+
+    def download(self, key, story_path):
+        """
+        Download the story with the given key into the given path.
+
+        The story is first downloaded into a temporary directory and then moved in place
+        so that an interrupted download never leaves a partial story behind.
+
+        Returns whether the story was found.
+        """
+        try:
+            response = self.session.get(f"{self.url}/v1/stories/{key}", timeout=self.timeout)
+            if response.status_code == 404:
+                logging.debug("Story %s not found in the shared cache", key)
+                return False
+            response.raise_for_status()
+            files = response.json()["files"]
+
+            story_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = Path(tempfile.mkdtemp(prefix=".download_", dir=story_path.parent))
+            try:
+                for name in files:
+                    response = self.session.get(f"{self.url}/v1/stories/{key}/{name}", timeout=self.timeout)
+                    response.raise_for_status()
+                    (tmp_path / name).write_bytes(response.content)
+                # Only complete stories make it to the shared cache.
+                utils.mark_story_complete(tmp_path)
+                tmp_path.rename(story_path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except (requests.RequestException, OSError, KeyError, ValueError) as e:
+            logging.warning("Failed to download story %s from the shared cache: %s", key, e)
+            return False
+
+        logging.info("Downloaded story %s from the shared cache into %s", key, story_path)
+        return True
+
+    def upload(self, key, story_path):
+        """
+        Upload the story at the given path under the given key.
+
+        The manifest is uploaded last, which makes the story visible to the other devices.
+        """
+        files = sorted(
+            path.name
+            for path in story_path.iterdir()
+            if path.name == "info.yaml" or path.name.startswith("paragraph_")
+        )
+        try:
+            for name in files:
+                response = self.session.put(
+                    f"{self.url}/v1/stories/{key}/{name}",
+                    data=(story_path / name).read_bytes(),
+                    timeout=self.timeout,
+                )
+                if response.status_code == 409:
+                    logging.debug("Story %s is already in the shared cache", key)
+                    return
+                response.raise_for_status()
+
+            response = self.session.put(
+                f"{self.url}/v1/stories/{key}", json={"files": files}, timeout=self.timeout
+            )
+            response.raise_for_status()
+        except (requests.RequestException, OSError) as e:
+            logging.warning("Failed to upload story %s to the shared cache: %s", key, e)
+            return
+
+        logging.info("Uploaded story %s to the shared cache", key)
@@ -0,0 +1,104 @@
+"""
+Transcoding of the cached story audio.
+
+Replaying a cached story decodes its audio every time, which is a noticeable share of the CPU of small
+devices. The audio cache format trades storage against CPU at playback time:
+
+* "original" keeps the audio in the format returned by the TTS service
+* "pcm" stores uncompressed WAV, the largest but free to play
+* "opus" stores Opus, the smallest and cheaper to decode than MP3
+
+Stories are transcoded in the background while Fably is idle.
+"""
+
+import logging
+import time
+
+import soundfile as sf
+
+from fably import utils
+
+# The file extension, soundfile format and subtype of each audio cache format.
+CACHE_FORMATS = {
+    "pcm": ("wav", "WAV", "PCM_16"),
+    "opus": ("opus", "OGG", "OPUS"),
+}
+IDLE_WAIT = 5
+
+
+def transcode_audio(audio_file, cache_format):
+    """
+    Transcode the given audio file to the given cache format, next to the original file.
+
+    Returns the path of the transcoded file.
+    """
+    extension, file_format, subtype = CACHE_FORMATS[cache_format]
+    output_file = audio_file.with_suffix(f".{extension}")
+    if output_file == audio_file:
+        return audio_file
+
+    audio_data, sample_rate = sf.read(audio_file, dtype="int16")
+    if file_format == "OGG" and sample_rate not in (8000, 12000, 16000, 24000, 48000):
+        raise ValueError(f"Opus doesn't support the {sample_rate}Hz sample rate of {audio_file}")
+
+    # Write to a temporary file first so that an interruption never leaves a truncated file behind.
+    tmp_file = utils.temporary_path(output_file)
+    sf.write(tmp_file, audio_data, sample_rate, format=file_format, subtype=subtype)
+    tmp_file.replace(output_file)
+
+    return output_file
+
+
+def pending_audio_files(stories_path, cache_format):
+    """
+    Yield the paragraph audio files of the cached stories that are not in the given cache format yet.
+    """
+    extension, _, _ = CACHE_FORMATS[cache_format]
+    for story_path in sorted(stories_path.iterdir()):
+        if not story_path.is_dir():
+            continue
+        for audio_file in sorted(story_path.glob("paragraph_*.*")):
+            if audio_file.suffix[1:] in utils.AUDIO_FORMATS and audio_file.suffix[1:] != extension:
+                yield audio_file
+
+
+def wait_until_idle(ctx):
+    """
+    Wait until no story is being told. Returns False if Fably is shutting down instead.
+    """
+    while ctx.talking and ctx.running:
+        time.sleep(IDLE_WAIT)
+    return ctx.running
+
+
+def is_in_use(ctx, story_path):
+    """
+    Check whether the story at the given path is being told or uploaded, its files have to stay where they are.
+    """
+    return story_path in ctx.playing or story_path in ctx.uploading
+
+
+def transcode_stories(ctx):
+    """
+    Transcode the audio of all the cached stories to the configured audio cache format,
+    one file at a time and only while no story is being told, leaving alone the ones in use.
+    """
+    if ctx.audio_cache_format not in CACHE_FORMATS:
+        return
+
+    for audio_file in pending_audio_files(ctx.stories_path, ctx.audio_cache_format):
+        if not wait_until_idle(ctx):
+            return
+
+        # Its files would vanish under the player or the upload, it's transcoded the next time around.
+        if is_in_use(ctx, audio_file.parent):
+            continue
+
+        try:
+            output_file = transcode_audio(audio_file, ctx.audio_cache_format)
+            logging.debug("Transcoded %s to %s", audio_file, output_file)
+            # The story may have started playing meanwhile, in which case the original is removed next time.
+            if output_file != audio_file and not is_in_use(ctx, audio_file.parent):
+                audio_file.unlink()
+        except (sf.LibsndfileError, RuntimeError, ValueError, OSError) as e:
+            logging.warning("Failed to transcode %s: %s", audio_file, e)
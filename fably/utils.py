@@ -2,12 +2,15 @@
 Shared utility functions.
 """
 
+import io
 import os
 import re
 import logging
+import subprocess
 import json
 import time
 import colorsys
+import difflib
 import zipfile
 import queue
 
@@ -21,10 +24,19 @@ import soundfile as sf
 
 from vosk import Model, KaldiRecognizer
 
+from fably import audio_analysis
+
 
 MAX_FILE_LENGTH = 255
 SOUNDS_PATH = "sounds"
 QUERY_SAMPLE_RATE = 16000
+SILENCE_DURATION = 1.0
+AUDIO_FORMATS = ("mp3", "wav", "ogg", "opus", "flac", "aac")
+STORY_COMPLETE_MARKER = ".complete"
+# Written in the stories path once the stories cached before completion was marked have been migrated.
+LEGACY_STORIES_MIGRATED = ".migrated"
+# Queries whose beginning is less similar than this to the query guard clearly don't start with it.
+GUARD_MISMATCH_RATIO = 0.5
 
 
 def rotate_rgb_color(rgb_value, step_size=1):
@@ -93,6 +105,15 @@ def get_speech_recognizer(models_path, model_name):
     """
     Return a speech recognizer instance using the given model.
 
+    The model is downloaded if not already available.
+    """
+    return speech_recognizer(get_speech_model(models_path, model_name))
+
+
+def get_speech_model(models_path, model_name):
+    """
+    Return the speech recognition model with the given name.
+
     The model is downloaded if not already available.
     """
     model_dir = Path(models_path) / Path(model_name)
@@ -119,10 +140,23 @@ def get_speech_recognizer(models_path, model_name):
         os.remove(zip_path)
         logging.debug("Model %s downloaded and unpacked in %s", model_name, model_dir)
 
-    model = Model(str(model_dir))
-    return KaldiRecognizer(
-        model, QUERY_SAMPLE_RATE
-    )  # The sample rate is fixed in the model
+    return Model(str(model_dir))
+
+
+def speech_recognizer(model, grammar=None):
+    """
+    Return a speech recognizer instance using the given model,
+    only recognizing the given phrases if a grammar is given.
+
+    Its results include the confidence of each word recognized.
+    """
+    # The sample rate is fixed in the model
+    if grammar:
+        recognizer = KaldiRecognizer(model, QUERY_SAMPLE_RATE, json.dumps(grammar))
+    else:
+        recognizer = KaldiRecognizer(model, QUERY_SAMPLE_RATE)
+    recognizer.SetWords(True)
+    return recognizer
 
 
 def write_audio_data_to_file(audio_data, audio_file, sample_rate):
@@ -152,6 +186,9 @@ def play_audio_file(audio_file, audio_driver="alsa"):
     elif audio_driver == "alsa":
         if audio_file.suffix == ".mp3":
             os.system(f"mpg123 {audio_file}")
+        elif audio_file.suffix in (".ogg", ".opus"):
+            # aplay can't decode Opus so we decode it here and pipe the samples to it.
+            pipe_to_player(["aplay", "-q", "-"], decode_to_wav(audio_file))
         else:
             os.system(f"aplay {audio_file}")
     else:
@@ -159,6 +196,40 @@ def play_audio_file(audio_file, audio_driver="alsa"):
     logging.debug("Done playing %s with %s", audio_file, audio_driver)
 
 
+def decode_to_wav(audio):
+    """
+    Decode the given audio file (or file-like object) into WAV bytes.
+    """
+    audio_data, sampling_frequency = sf.read(audio, dtype="int16")
+    wav = io.BytesIO()
+    sf.write(wav, audio_data, sampling_frequency, format="WAV", subtype="PCM_16")
+    return wav.getbuffer()
+
+
+def pipe_to_player(player, audio_data):
+    """
+    Play the given audio data by piping it to the standard input of the given player command.
+    """
+    with subprocess.Popen(player, stdin=subprocess.PIPE) as process:
+        process.stdin.write(audio_data)
+        process.stdin.close()
+
+
+def find_paragraph_audio(story_path, index, preferred_format=None):
+    """
+    Return the path of the audio of the given paragraph of a story, whatever its format, or None if there is none.
+
+    The preferred format is checked first since it's the most likely to be there.
+    """
+    audio_formats = [preferred_format] if preferred_format else []
+    audio_formats += [audio_format for audio_format in AUDIO_FORMATS if audio_format != preferred_format]
+    for audio_format in audio_formats:
+        audio_file = story_path / f"paragraph_{index}.{audio_format}"
+        if audio_file.exists():
+            return audio_file
+    return None
+
+
 def query_to_filename(query, prefix):
     """
     Convert a query from a voice assistant into a file name that can be used to save the story.
@@ -176,12 +247,89 @@ def query_to_filename(query, prefix):
     return re.sub(r'[\\/*?:"<>| ]', "_", query)[:MAX_FILE_LENGTH]
 
 
+def normalize_query(query):
+    """
+    Return the given query in lowercase, without punctuation and with single spaces between words.
+    """
+    return " ".join(re.sub(r"[^\w\s']", " ", query.lower()).split())
+
+
+def same_query(query, other_query):
+    """
+    Check whether the given queries are the same, regardless of case and punctuation
+    which differ between the local and the cloud transcripts.
+    """
+    return normalize_query(query) == normalize_query(other_query)
+
+
+def temporary_path(path):
+    """
+    Return the path of the temporary file to write before atomically renaming it to the given path.
+    """
+    path = Path(path)
+    return path.with_name(path.name + ".tmp")
+
+
 def write_to_file(path, text):
     """
     Write the given text to a file at the given path.
+
+    The text is written to a temporary file first and renamed in place,
+    so that an interruption never leaves a truncated file behind.
     """
-    with open(path, "w", encoding="utf8") as f:
+    tmp_path = temporary_path(path)
+    with open(tmp_path, "w", encoding="utf8") as f:
         f.write(text)
+    tmp_path.replace(path)
+
+
+def is_story_complete(story_path):
+    """
+    Return whether the text of the story at the given path was completely generated.
+    """
+    return (story_path / STORY_COMPLETE_MARKER).exists()
+
+
+def mark_story_complete(story_path):
+    """
+    Mark the text of the story at the given path as completely generated.
+    """
+    (story_path / STORY_COMPLETE_MARKER).touch()
+
+
+def migrate_legacy_stories(stories_path):
+    """
+    Mark the stories cached before completion was marked as complete, once per stories path.
+
+    Only the ones whose paragraphs all have audio and that have no temporary files left over are,
+    the others are really interrupted and are resumed or generated again.
+    """
+    stories_path = Path(stories_path)
+    migrated = stories_path / LEGACY_STORIES_MIGRATED
+    if not stories_path.is_dir() or migrated.exists():
+        return
+
+    for story_path in stories_path.iterdir():
+        if not story_path.is_dir() or is_story_complete(story_path):
+            continue
+        paragraphs = count_paragraphs(story_path)
+        if not paragraphs or any(story_path.glob("*.tmp")):
+            continue
+        if all(find_paragraph_audio(story_path, index) for index in range(paragraphs)):
+            logging.info("Marking the legacy story at %s as complete", story_path)
+            mark_story_complete(story_path)
+
+    migrated.touch()
+
+
+def count_paragraphs(story_path):
+    """
+    Return the number of consecutive paragraphs whose text is in the story at the given path.
+    """
+    index = 0
+    while (story_path / f"paragraph_{index}.txt").exists():
+        index += 1
+    return index
 
 
 def read_from_file(path):
@@ -199,21 +347,93 @@ def write_to_yaml(path, data):
         yaml.dump(data, file, default_flow_style=False)
 
 
+def read_from_yaml(path):
+    """
+    Read the data in the YAML file at the given path.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        return yaml.safe_load(file)
+
+
+def match_query_guard(text, query_guard):
+    """
+    Check whether the given transcript, possibly partial or approximate, starts with the query guard.
+
+    Returns True if it does, False if it clearly doesn't and None if it's too early to tell.
+    """
+    words = text.lower().split()
+    guard_words = query_guard.lower().split()
+    if len(words) < len(guard_words):
+        return None
+
+    beginning = " ".join(words[: len(guard_words)])
+    if beginning == " ".join(guard_words):
+        return True
+    ratio = difflib.SequenceMatcher(None, beginning, " ".join(guard_words)).ratio()
+    return False if ratio < GUARD_MISMATCH_RATIO else None
+
+
+def check_query_guard(recognizer, query_guard, on_guard=None):
+    """
+    Check whether the partial result of the recognizer starts with the query guard, see match_query_guard,
+    calling on_guard if it does.
+
+    Returns the partial result and whether it matched.
+    """
+    partial = json.loads(recognizer.PartialResult())["partial"]
+    guard_matched = match_query_guard(partial, query_guard)
+    if guard_matched and on_guard:
+        on_guard()
+    return partial, guard_matched
+
+
 def record_until_silence(
-    recognizer, trim_first_frame=False, sample_rate=QUERY_SAMPLE_RATE
+    recognizer,
+    trim_first_frame=False,
+    sample_rate=QUERY_SAMPLE_RATE,
+    *,
+    silence_threshold=None,
+    silence_duration=SILENCE_DURATION,
+    preroll=None,
+    query_guard=None,
+    on_guard=None,
 ):
     """
     Records audio until silence is detected.
     This uses a tiny speech recognizer (vosk) to detect silence.
 
-    Returns an nparray of int16 samples.
+    If a silence threshold is given, recording also stops once the energy of the sound stayed below it
+    for the given duration after speech was heard, which vosk alone is slow to notice in noisy rooms.
+
+    Blocks of audio recorded just before, e.g. while listening for the wake phrase, can be given
+    as preroll: they are treated as the beginning of the recording.
+
+    If a query guard is given, the partial results of the recognizer are checked against it as they come:
+    recording stops as soon as the query clearly doesn't start with it, and on_guard is called
+    once when it does, so that the caller can get ready while the query is still being said.
+
+    Returns an nparray of int16 samples, their sample rate, the local transcript and the lowest confidence
+    of its words, which is 0 when there are none or they weren't all recognized with a confidence.
 
     NOTE: There are probably less overkill ways to do this but this works well enough for now.
     """
     query = []
+    words = []
     recorded_frames = []
     recognition_queue = queue.Queue()
 
+    block_size = sample_rate // 4
+    detector = (
+        audio_analysis.SilenceDetector(block_size, silence_threshold, silence_duration * sample_rate)
+        if silence_threshold
+        else None
+    )
+    guard_matched = None
+
+    for block in preroll or []:
+        recognition_queue.put(block)
+        recorded_frames.append(block)
+
     def callback(indata, frames, _time, _status):
         """This function is called for each audio block from the microphone"""
         logging.debug("Recorded audio frame with %i samples", frames)
@@ -222,7 +442,7 @@ def record_until_silence(
 
     with sd.RawInputStream(
         samplerate=sample_rate,
-        blocksize=sample_rate // 4,
+        blocksize=block_size,
         dtype="int16",
         channels=1,
         callback=callback,
@@ -235,17 +455,37 @@ def record_until_silence(
                 result = json.loads(recognizer.Result())
                 if result["text"]:
                     query.append(result["text"])
+                    words.extend(result.get("result", []))
+                    break
+            elif query_guard and guard_matched is None:
+                partial, guard_matched = check_query_guard(recognizer, query_guard, on_guard)
+                if guard_matched is False:
+                    logging.debug("Stopped recording, '%s' is not a query", partial)
                     break
 
-        final_result = json.loads(recognizer.FinalResult())
-        query.append(final_result["text"])
+            if detector and detector.is_done(np.frombuffer(data, dtype=np.int16)):
+                logging.debug("Stopped recording after %.2fs of silence", silence_duration)
+                break
+
+        if guard_matched is False:
+            query.append(partial)
+            recognizer.Reset()
+        else:
+            final_result = json.loads(recognizer.FinalResult())
+            query.append(final_result["text"])
+            words.extend(final_result.get("result", []))
 
     npframes = [np.frombuffer(frame, dtype=np.int16) for frame in recorded_frames]
 
     if trim_first_frame:
         npframes = npframes.pop(0)
 
-    return np.concatenate(npframes, axis=0), sample_rate, " ".join(query)
+    text = " ".join(query)
+    # Words recognized without a confidence, e.g. the partial ones, don't count as confident.
+    confident_words = len(words) == len(text.split())
+    confidence = min((word["conf"] for word in words), default=0.0) if confident_words else 0.0
+
+    return np.concatenate(npframes, axis=0), sample_rate, text, confidence
 
 
 def transcribe(
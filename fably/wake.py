@@ -0,0 +1,149 @@
+"""
+Hands-free listening for the wake phrase.
+
+A speech recognizer restricted to a grammar made of the query guard alone is cheap, but it still costs too
+much CPU to run on every block of audio of an idle device. Blocks are first gated by their energy: the
+recognizer only runs while the sound is above the silence threshold, starting with a short preroll so the
+beginning of the phrase isn't lost, and it's given a rest after running for a while on continuous noise.
+
+Once the wake phrase is heard, the audio of the whole utterance is handed over to the query capture so that
+the rest of the query, which the child keeps saying, is captured too.
+"""
+
+import collections
+import json
+import logging
+import queue
+import time
+
+import numpy as np
+import sounddevice as sd
+
+from fably import audio_analysis
+from fably import utils
+
+BLOCK_SIZE = utils.QUERY_SAMPLE_RATE // 10
+PREROLL_BLOCKS = 5
+# After this many silent blocks, the utterance is over.
+SILENT_BLOCKS = 10
+# The recognizer rests for a while after running on this many blocks without hearing the wake phrase.
+MAX_ACTIVE_BLOCKS = 50
+REST_BLOCKS = 50
+IDLE_WAIT = 0.5
+CPU_REPORT_INTERVAL = 60
+
+
+class CpuMeter:
+    """
+    Measures the share of a CPU used by the calling thread and reports it periodically.
+    """
+
+    def __init__(self, name, interval=CPU_REPORT_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.load = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.start_time = time.monotonic()
+        self.start_cpu = time.thread_time()
+
+    def update(self):
+        """
+        Update the measured CPU load, reporting it if the interval elapsed.
+        """
+        elapsed = time.monotonic() - self.start_time
+        if elapsed < self.interval:
+            return
+        self.load = (time.thread_time() - self.start_cpu) / elapsed
+        logging.debug("%s used %.1f%% of a CPU", self.name, 100 * self.load)
+        self._reset()
+
+
+def wait_for_wake_phrase(ctx, recognizer, cpu_meter):
+    """
+    Listen until the wake phrase is heard and return the audio blocks of the utterance that contains it,
+    or None if a story started in the meantime or Fably is shutting down.
+    """
+    analyzer = audio_analysis.BlockAnalyzer(BLOCK_SIZE)
+    threshold = ctx.silence_threshold or 0
+    blocks = queue.Queue()
+    preroll = collections.deque(maxlen=PREROLL_BLOCKS)
+    utterance = []
+    silent_blocks = 0
+    rest_blocks = 0
+
+    def callback(indata, _frames, _time, _status):
+        blocks.put(bytes(indata))
+
+    with sd.RawInputStream(
+        samplerate=utils.QUERY_SAMPLE_RATE,
+        blocksize=BLOCK_SIZE,
+        dtype="int16",
+        channels=1,
+        callback=callback,
+    ):
+        logging.debug("Listening for '%s'...", ctx.query_guard)
+
+        while ctx.running and not ctx.talking:
+            cpu_meter.update()
+            try:
+                data = blocks.get(timeout=IDLE_WAIT)
+            except queue.Empty:
+                continue
+
+            loud = analyzer.rms(np.frombuffer(data, dtype=np.int16)) >= threshold
+
+            if rest_blocks:
+                rest_blocks -= 1
+                continue
+
+            if not utterance:
+                if not loud:
+                    preroll.append(data)
+                    continue
+                utterance = list(preroll)
+                preroll.clear()
+                for block in utterance:
+                    recognizer.AcceptWaveform(block)
+
+            utterance.append(data)
+            silent_blocks = 0 if loud else silent_blocks + 1
+
+            if recognizer.AcceptWaveform(data):
+                text = json.loads(recognizer.Result())["text"]
+            else:
+                text = json.loads(recognizer.PartialResult())["partial"]
+
+            if ctx.query_guard in text:
+                logging.info("Heard the wake phrase")
+                recognizer.Reset()
+                return utterance
+
+            if silent_blocks >= SILENT_BLOCKS or len(utterance) >= MAX_ACTIVE_BLOCKS:
+                if len(utterance) >= MAX_ACTIVE_BLOCKS:
+                    rest_blocks = REST_BLOCKS
+                recognizer.Reset()
+                utterance = []
+                silent_blocks = 0
+
+    return None
+
+
+def listen_for_wake_phrase(ctx, tell_story):
+    """
+    Keep listening for the wake phrase while no story is being told,
+    calling tell_story with the audio of the utterance each time it's heard.
+    """
+    recognizer = utils.speech_recognizer(ctx.speech_model, [ctx.query_guard, "[unk]"])
+    cpu_meter = CpuMeter("Wake phrase listening")
+
+    while ctx.running:
+        if ctx.talking:
+            time.sleep(IDLE_WAIT)
+            continue
+
+        utterance = wait_for_wake_phrase(ctx, recognizer, cpu_meter)
+        if utterance:
+            ctx.talking = True
+            tell_story(utterance)
@@ -0,0 +1,64 @@
+"""
+Warm-up of the services a story needs, while the child is still asking for it.
+
+Opening a connection to a service, and negotiating TLS over it, takes a few round trips that the first
+request would otherwise wait for. As soon as a voice query starts, a cheap request is sent to each of
+the services so that the real requests reuse a connection that's already open.
+
+LLM endpoints served by Ollama are also asked to load their model, in case it was unloaded,
+see fably/ollama.py.
+"""
+
+import asyncio
+import logging
+
+import openai
+
+from fably import ollama
+
+
+def warm_up_stt(ctx):
+    """
+    Open the connection to the speech-to-text service.
+    """
+    try:
+        # Any request will do, it's only about having the connection open when the query is sent.
+        ctx.stt_client.models.list()
+    except openai.OpenAIError as e:
+        logging.debug("Warming up %s failed: %s", ctx.stt_url, e)
+
+
+async def warm_up_client(client):
+    """
+    Open the connection of the given asynchronous client to its service.
+    """
+    try:
+        await client.models.list()
+    except openai.OpenAIError as e:
+        logging.debug("Warming up %s failed: %s", client.base_url, e)
+
+
+async def warm_up(ctx):
+    """
+    Warm up all the services that the story may need: the speech-to-text service, every endpoint of
+    the LLM and TTS services and the models of the LLM endpoints served by Ollama.
+
+    The connections of the asynchronous clients belong to the event loop of the story,
+    so this has to run in it.
+    """
+    loop = asyncio.get_running_loop()
+    urls = [ctx.llm_url] + [url for _, url in ctx.llm_race] + [ctx.llm_hedge_url]
+    urls += [ctx.tts_url] + [url for _, url in ctx.tts_race] + [ctx.tts_hedge_url]
+
+    logging.debug("Warming up the services...")
+    await asyncio.gather(
+        loop.run_in_executor(None, warm_up_stt, ctx),
+        *[warm_up_client(ctx.client_for(url)) for url in dict.fromkeys(urls) if url],
+        *[
+            loop.run_in_executor(
+                None, ollama.preload_model, url, model, ollama.keep_alive(ctx)
+            )
+            for model, url in ollama.endpoints(ctx)
+        ],
+    )
+    logging.debug("Warmed up the services")
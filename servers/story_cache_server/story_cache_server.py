@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import json
+import os
+import re
+import tempfile
+
+from pathlib import Path
+
+import click
+from flask import Flask, request, jsonify, send_from_directory
+
+app = Flask(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+FILE_PATTERN = re.compile(r'^(paragraph_\d+\.\w+|info\.yaml)$')
+
+
+def story_path(key):
+    return app.config['STORIES_PATH'] / key
+
+
+def write_atomically(path, data):
+    """Write the data to a temporary file next to the target and rename it, so readers never see partial files."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, path)
+
+
+@app.route('/v1/stories/<key>', methods=['GET'])
+def manifest_handler(key):
+    if not KEY_PATTERN.match(key):
+        return jsonify({"error": "Invalid story key."}), 400
+
+    # The manifest is uploaded last, stories without one are still being uploaded.
+    manifest_path = story_path(key) / MANIFEST_FILE
+    if not manifest_path.exists():
+        return jsonify({"error": "Story not found."}), 404
+
+    return jsonify(json.loads(manifest_path.read_text(encoding='utf-8'))), 200
+
+
+@app.route('/v1/stories/<key>', methods=['PUT'])
+def complete_handler(key):
+    if not KEY_PATTERN.match(key):
+        return jsonify({"error": "Invalid story key."}), 400
+
+    manifest = request.get_json()
+    if not manifest or 'files' not in manifest:
+        return jsonify({"error": "Invalid request. 'files' field is required."}), 400
+
+    missing = [name for name in manifest['files'] if not (story_path(key) / name).exists()]
+    if missing:
+        return jsonify({"error": f"Missing story files: {missing}"}), 409
+
+    write_atomically(story_path(key) / MANIFEST_FILE, json.dumps(manifest).encode('utf-8'))
+    return jsonify({"status": "Story stored"}), 201
+
+
+@app.route('/v1/stories/<key>/<name>', methods=['GET'])
+def file_handler(key, name):
+    if not KEY_PATTERN.match(key) or not FILE_PATTERN.match(name):
+        return jsonify({"error": "Invalid story file."}), 400
+    return send_from_directory(story_path(key), name)
+
+
+@app.route('/v1/stories/<key>/<name>', methods=['PUT'])
+def upload_handler(key, name):
+    if not KEY_PATTERN.match(key) or not FILE_PATTERN.match(name):
+        return jsonify({"error": "Invalid story file."}), 400
+
+    # Complete stories are immutable.
+    if (story_path(key) / MANIFEST_FILE).exists():
+        return jsonify({"error": "Story already stored."}), 409
+
+    write_atomically(story_path(key) / name, request.get_data())
+    return jsonify({"status": "File stored"}), 201
+
+
+@app.route('/status', methods=['GET'])
+def status_handler():
+    return jsonify({"status": "Service is up and running"}), 200
+
+
+@click.command()
+@click.option('--host', default='0.0.0.0', help='Host to run the web service on.')
+@click.option('--port', default=5002, help='Port to run the web service on.')
+@click.option('--stories_path', default='./stories', help='Directory to store the shared stories in.')
+def main(host, port, stories_path):
+    app.config['STORIES_PATH'] = Path(stories_path).resolve()
+    app.config['STORIES_PATH'].mkdir(parents=True, exist_ok=True)
+
+    app.run(host=host, port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
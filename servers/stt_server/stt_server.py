@@ -5,21 +5,47 @@ from pathlib import Path
 
 import click
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from faster_whisper import WhisperModel
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 app = Flask(__name__)
 
+# The model transcribes this many requests at a time, the others queue up inside of it.
+MODEL_WORKERS = 1
+# The requests being transcribed or waiting for the model, the set is only there to count them.
+TRANSCRIPTIONS = set()
+
+REQUESTS = Counter('stt_requests', 'Transcription requests by outcome (ok, invalid, error).', ['result'])
+IN_FLIGHT = Gauge('stt_requests_in_flight', 'Transcription requests being answered.')
+QUEUED = Gauge('stt_queued_requests', 'Transcription requests waiting for the model.')
+INFERENCE_SECONDS = Histogram(
+    'stt_inference_seconds', 'Time spent transcribing each request.', buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+AUDIO_SECONDS = Counter('stt_audio_seconds', 'Seconds of audio transcribed.')
+QUEUED.set_function(lambda: max(0, len(TRANSCRIPTIONS) - MODEL_WORKERS))
+
 
 def transcribe(model, audio_path, language):
-    segments, _ = model.transcribe(audio_path, language=language)
-    return ''.join(segment.text for segment in segments).strip()
+    token = object()
+    TRANSCRIPTIONS.add(token)
+    try:
+        with INFERENCE_SECONDS.time():
+            segments, info = model.transcribe(audio_path, language=language)
+            # Segments are lazily generated so the transcription happens here.
+            text = ''.join(segment.text for segment in segments).strip()
+    finally:
+        TRANSCRIPTIONS.discard(token)
+    AUDIO_SECONDS.inc(info.duration)
+    return text
 
 
 @app.route('/v1/audio/transcriptions', methods=['POST'])
+@IN_FLIGHT.track_inprogress()
 def transcriptions_handler():
     try:
         if "file" not in request.files:
+            REQUESTS.labels('invalid').inc()
             return jsonify({"error": "No audio file provided"}), 400
 
         audio_file = request.files['file']
@@ -33,10 +59,12 @@ def transcriptions_handler():
             transcription = transcribe(app.config['STT_MODEL'], str(tmp_path), app.config['LANGUAGE'])
 
         # Return the transcription result as a single string
+        REQUESTS.labels('ok').inc()
         return jsonify({"text": transcription}), 200
 
     except Exception as e:  # pylint: disable=broad-except
         print(e)
+        REQUESTS.labels('error').inc()
         return jsonify({"error": str(e)}), 500
 
 
@@ -45,6 +73,11 @@ def status_handler():
     return jsonify({"status": "Service is up and running"}), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST), 200
+
+
 @click.command()
 @click.option('--host', default='0.0.0.0', help='Host to run the web service on.')
 @click.option('--port', default=5000, help='Port to run the web service on.')
@@ -53,7 +86,7 @@ def status_handler():
 def main(host, port, language, stt_model):
     app.config['LANGUAGE'] = language
 
-    app.config['STT_MODEL'] = WhisperModel(stt_model)
+    app.config['STT_MODEL'] = WhisperModel(stt_model, num_workers=MODEL_WORKERS)
 
     # Test that models work before exposing the service.
     test_audio_path = Path(__file__).resolve().parent / 'hi.wav'
@@ -0,0 +1,117 @@
+"""
+Batched synthesis with the WhisperSpeech pipeline.
+
+Pipeline.generate synthesizes a single sentence, and the `bs` argument of its models only samples several
+variants of that same sentence. Their encoders and decoding steps take a batch of different sentences just
+as well, so this runs them the way their generate methods do, one row per sentence, and cuts each row where
+its own sentence ends. The kv-caches are sized for the largest batch by `optimize`.
+
+Batches are padded to a power of two so that the compiled decoding steps only ever see a handful of shapes,
+all of which are compiled while warming up.
+
+NOTE: This imports torch so it has to be imported after use_model_cache ran.
+"""
+
+import torch
+import torch.nn.functional as F
+
+from whisperspeech import inference, languages
+
+TEMPERATURE = 0.7  # Same as Pipeline.generate.
+
+
+def optimize(model, max_batch_size, torch_compile=True):
+    """Optimize a pipeline created with optimize=False for batches of up to the given size."""
+    model.t2s.optimize(max_batch_size=max_batch_size, torch_compile=torch_compile)
+    model.s2a.optimize(max_batch_size=max_batch_size, torch_compile=torch_compile)
+
+
+def batch_sizes(max_batch_size):
+    """Return the sizes batches are padded to, up to the given maximum."""
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    return sizes + [max_batch_size]
+
+
+def generate_stoks(t2s, sentences):
+    """Generate the semantic tokens of each of the given (text, language, speed) sentences."""
+    t2s.ensure_tokenizer()
+    dev = t2s.device
+    steps = t2s.stoks_len
+    end = t2s.stoks_codes + t2s.tunables.padding_token_offset
+
+    ttoks = []
+    for text, _, _ in sentences:
+        tokens = torch.tensor(t2s.tokenizer.encode(text.replace("\n", " ")), device=dev)
+        ttoks.append(F.pad(tokens, (1, t2s.ttoks_len - len(tokens) - 1), value=t2s.tokenizer.eot))
+    ttoks = torch.stack(ttoks)
+    langs = torch.tensor([languages.to_id(language) for _, language, _ in sentences], device=dev)
+    cpss = torch.tensor([speed for _, _, speed in sentences], device=dev)
+    temperature = torch.tensor(TEMPERATURE, device=dev)
+
+    toks = torch.zeros((len(sentences), steps), dtype=torch.long, device=dev)
+    toks[:, 0] = end
+    positions = torch.arange(steps + 1, device=dev)
+    xenc, xenc_positions, cps_emb = t2s.run_encoder(ttoks, langs, cpss)
+    toks[:, 1] = t2s.generate_one(
+        toks[:, :1].contiguous(), positions[:1], cps_emb, xenc, xenc_positions, temperature, None
+    )[:, 0]
+    with inference.inference_context():
+        for i in range(1, steps - 1):
+            toks[:, i + 1] = t2s.generate_next(
+                toks[:, i : i + 1], positions[i : i + 1], cps_emb, xenc, xenc_positions, temperature, None
+            )[:, 0]
+            if (toks[:, i + 1] == end).all():
+                break
+
+    # Sentences that ended early kept being decoded along with the others, that's cut off here.
+    stoks = []
+    for row in toks[:, 1:]:
+        ends = (row == end).nonzero()
+        stoks.append(row[: ends[0, 0]] if len(ends) else row)
+    return stoks
+
+
+def generate_atoks(s2a, stoks, speaker):
+    """Generate the acoustic tokens of each of the given semantic tokens with the given speaker."""
+    dev = s2a.device
+    lengths = [len(row) * 3 for row in stoks]
+    steps = max(lengths)
+
+    padded = torch.stack(
+        [F.pad(row.to(dev), (1, s2a.stoks_len - len(row) - 1), value=s2a.stoks_codes - 1) for row in stoks]
+    )
+    speakers = speaker.to(device=dev, dtype=s2a.dtype).unsqueeze(0).repeat(len(stoks), 1)
+    toks = torch.full((len(stoks), s2a.quantizers, s2a.ctx_n), s2a.codes + 1, dtype=torch.long, device=dev)
+    temperature = torch.tensor(TEMPERATURE, device=dev)
+
+    xenc, xenc_positions, _ = s2a.run_encoder(padded, speakers)
+    positions = torch.arange(steps, device=dev)
+    toks[:, :1, 1:2] = s2a.generate_one(
+        toks[:, :, :1], positions[:1], None, xenc, xenc_positions, temperature, None
+    )[:, :1]
+    with inference.inference_context():
+        for i in range(2, min(steps, s2a.ctx_n - 1)):
+            toks[:, :i, i : i + 1] = s2a.generate_next(
+                toks[:, :, i - 1 : i], positions[i - 1 : i], None, xenc, xenc_positions, temperature, None
+            )[:, :i]
+
+    # Undo the delay pattern of the quantizers, each row is as long as it would be on its own.
+    toks = toks[:, :, 1:steps]
+    for j in range(s2a.quantizers):
+        toks[:, j] = torch.roll(toks[:, j], -j)
+    return [toks[index : index + 1, :, : length - 4] for index, length in enumerate(lengths)]
+
+
+def synthesize_batch(model, sentences, max_batch_size):
+    """Synthesize the given (text, language, speed) sentences at once and return their audio, in order."""
+    size = next(size for size in batch_sizes(max_batch_size) if size >= len(sentences))
+    padded = sentences + [sentences[0]] * (size - len(sentences))
+
+    stoks = generate_stoks(model.t2s, padded)
+    atoks = generate_atoks(model.s2a, stoks, model.default_speaker)
+    # The vocoder runs on each sentence alone so that none of them hears the end of a longer one.
+    return [model.vocoder.decode(tokens) for tokens in atoks[: len(sentences)]]
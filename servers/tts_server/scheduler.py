@@ -0,0 +1,123 @@
+"""
+Scheduler that groups the sentences of concurrent requests into batches for the WhisperSpeech pipeline.
+
+Every request submits its sentences and gets a future back for each of them. A single worker thread owns the
+pipeline: it waits for up to `max_wait` seconds for sentences to come in, then synthesizes up to
+`max_batch_size` of them in a single batch and hands the audio back to the requests. Batches take turns
+between the requests, one sentence of each at a time, so that the first sentence of a new request never waits
+behind all the sentences of the ones already queued. Requests asking for the same sentence while it's pending
+share a single synthesis.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+import numpy as np
+
+from prometheus_client import Counter, Gauge, Histogram
+
+SAMPLE_RATE = 24000  # WhisperSpeech's vocoder always emits 24kHz audio.
+
+QUEUED_SENTENCES = Gauge('tts_queued_sentences', 'Sentences waiting to be synthesized.')
+BATCH_SIZE = Histogram('tts_batch_size', 'Sentences synthesized in each batch.', buckets=(1, 2, 4, 8, 16, 32))
+INFERENCE_SECONDS = Histogram(
+    'tts_inference_seconds', 'Time spent synthesizing each batch.', buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+)
+AUDIO_SECONDS = Counter('tts_audio_seconds', 'Seconds of audio synthesized.')
+
+
+def to_pcm(audio):
+    """Convert the audio tensor returned by the pipeline into 16-bit PCM bytes."""
+    samples = np.clip(audio.cpu().numpy().reshape(-1), -1.0, 1.0)
+    return (samples * 32767).astype('<i2').tobytes()
+
+
+class SynthesisScheduler:
+    """Collects the sentences of concurrent requests and synthesizes them in batches on a single worker."""
+
+    def __init__(self, synthesize_batch, max_batch_size=8, max_wait=0.02):
+        # Takes a list of (text, language, speed) sentences and returns their audio, in order.
+        self.synthesize_batch = synthesize_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        # The sentences of each request still waiting, in the order the requests take turns.
+        self.requests = collections.deque()
+        # The futures waiting for each pending sentence, shared by the requests asking for it.
+        self.pending = {}
+        QUEUED_SENTENCES.set_function(lambda: len(self.pending))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentences, language, speed):
+        """Queue the sentences of a request and return futures that resolve to their PCM audio, in order."""
+        futures = []
+        queued = collections.deque()
+        with self.condition:
+            for sentence in sentences:
+                key = (sentence, language, speed)
+                futures.append(Future())
+                if key not in self.pending:
+                    self.pending[key] = []
+                    queued.append(key)
+                self.pending[key].append(futures[-1])
+            if queued:
+                self.requests.append(queued)
+                self.condition.notify()
+        return futures
+
+    def _collect(self):
+        with self.condition:
+            while not self.requests:
+                self.condition.wait()
+
+            # Give the sentences of other requests a chance to make it into the batch.
+            deadline = time.monotonic() + self.max_wait
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = []
+            while self.requests and len(batch) < self.max_batch_size:
+                queued = self.requests.popleft()
+                key = queued.popleft()
+                if queued:
+                    self.requests.append(queued)
+                batch.append((key, self.pending.pop(key)))
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            # Don't synthesize sentences for clients that went away.
+            batch = [
+                (key, [future for future in futures if future.set_running_or_notify_cancel()])
+                for key, futures in batch
+            ]
+            batch = [(key, futures) for key, futures in batch if futures]
+            if not batch:
+                continue
+
+            logging.debug("Synthesizing a batch of %i sentences", len(batch))
+            BATCH_SIZE.observe(len(batch))
+            try:
+                with INFERENCE_SECONDS.time():
+                    audios = self.synthesize_batch([key for key, _ in batch])
+            except Exception as e:  # pylint: disable=broad-except
+                for _, futures in batch:
+                    for future in futures:
+                        future.set_exception(e)
+                continue
+
+            for (_, futures), audio in zip(batch, audios):
+                pcm = to_pcm(audio)
+                AUDIO_SECONDS.inc(len(pcm) / 2 / SAMPLE_RATE)
+                for future in futures:
+                    future.set_result(pcm)
@@ -0,0 +1,114 @@
+"""
+Content-addressed cache of synthesized audio.
+
+Entries are keyed by a hash of everything that affects the synthesized audio and are kept in two tiers:
+a small in-memory tier for the hottest phrases and a larger on-disk tier. Both tiers are bounded by a
+byte budget and evict the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+
+
+def cache_key(text, language, model, speed, audio_format):
+    """Return the content address of the audio synthesized with the given parameters."""
+    params = json.dumps([text, language, model, speed, audio_format], ensure_ascii=False)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+
+class SynthesisCache:
+    """Two tier LRU cache of synthesized audio bounded by byte budgets."""
+
+    def __init__(self, cache_dir, max_bytes, hot_max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hot_max_bytes = hot_max_bytes
+        self.lock = threading.Lock()
+
+        self.hot = OrderedDict()
+        self.hot_bytes = 0
+
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        if self.max_bytes > 0:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._load_index()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def _load_index(self):
+        # Recover the recency order from the modification times, which get bumped on every hit.
+        files = [path for path in self.cache_dir.glob('*/*') if path.is_file() and not path.suffix]
+        for path in sorted(files, key=lambda path: path.stat().st_mtime):
+            size = path.stat().st_size
+            self.entries[path.name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self._path(key).unlink(missing_ok=True)
+
+        while self.hot_bytes > self.hot_max_bytes and self.hot:
+            _, audio = self.hot.popitem(last=False)
+            self.hot_bytes -= len(audio)
+
+    def _remember(self, key, audio):
+        if len(audio) > self.hot_max_bytes:
+            return
+        if key in self.hot:
+            self.hot.move_to_end(key)
+            return
+        self.hot[key] = audio
+        self.hot_bytes += len(audio)
+
+    def get(self, key):
+        """Return the cached audio for the given key or None if it's not cached."""
+        with self.lock:
+            audio = self.hot.get(key)
+            if audio is not None:
+                self.hot.move_to_end(key)
+                return audio
+
+            if key not in self.entries:
+                return None
+
+            path = self._path(key)
+            try:
+                audio = path.read_bytes()
+                os.utime(path)
+            except FileNotFoundError:
+                self.total_bytes -= self.entries.pop(key)
+                return None
+
+            self.entries.move_to_end(key)
+            self._remember(key, audio)
+            self._evict()
+            return audio
+
+    def put(self, key, audio):
+        """Store the audio for the given key, evicting older entries to stay within budget."""
+        if self.max_bytes <= 0 and self.hot_max_bytes <= 0:
+            return
+
+        with self.lock:
+            if self.max_bytes > 0 and key not in self.entries and len(audio) <= self.max_bytes:
+                path = self._path(key)
+                path.parent.mkdir(exist_ok=True)
+                tmp_path = path.with_suffix('.tmp')
+                tmp_path.write_bytes(audio)
+                os.replace(tmp_path, path)
+                self.entries[key] = len(audio)
+                self.total_bytes += len(audio)
+
+            self._remember(key, audio)
+            self._evict()
@@ -1,38 +1,244 @@
 #!/usr/bin/env python
 
-import tempfile
+import io
+import logging
+import os
+import re
+import struct
+import threading
+import time
+
+from pathlib import Path
 
 import click
-from flask import Flask, request, jsonify, send_file
-from whisperspeech.pipeline import Pipeline
+import numpy as np
+import soundfile as sf
+from flask import Flask, Response, request, jsonify, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest
+
+from scheduler import SAMPLE_RATE, SynthesisScheduler
+from synthesis_cache import SynthesisCache, cache_key
 
 app = Flask(__name__)
 
+# Sentences end like in fably/chunking.py, possibly followed by a closing quote or parenthesis.
+SENTENCE_BOUNDARY = re.compile(r'(?:(?<=[.!?])|(?<=[.!?]["\'”’)]))\s+')
+DEFAULT_FORMAT = 'mp3'  # Same default as the OpenAI API.
+
+# The response formats we can encode to in memory with their mime types.
+MIMETYPES = {
+    'wav': 'audio/wav',
+    'pcm': 'audio/pcm',
+    'mp3': 'audio/mpeg',
+    'opus': 'audio/ogg',
+    'flac': 'audio/flac',
+}
+
+# The soundfile format, subtype and encoder options for each compressed response format. MP3 is encoded
+# at a constant bitrate so that decoders can tell its duration without the header the encoder writes last.
+SOUNDFILE_FORMATS = {
+    'mp3': ('MP3', 'MPEG_LAYER_III', {'bitrate_mode': 'CONSTANT', 'compression_level': 0.5}),
+    'opus': ('OGG', 'OPUS', {}),
+    'flac': ('FLAC', 'PCM_16', {}),
+}
+
+REQUESTS = Counter('tts_requests', 'Speech requests by outcome (hit, miss, invalid, unavailable).', ['result'])
+IN_FLIGHT = Gauge('tts_requests_in_flight', 'Speech requests being answered.')
+
+
+def split_sentences(text):
+    """Split the text into sentences so that each one can be synthesized and sent on its own."""
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def streaming_wav_header(sample_rate, channels=1, bits_per_sample=16):
+    """
+    Return a WAV header for a stream of unknown length.
+
+    The size fields are set to their maximum value, like OpenAI does for its streamed WAV responses,
+    so that players keep reading until the connection is closed.
+    """
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    return (
+        b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        + b'data' + struct.pack('<I', 0xFFFFFFFF)
+    )
+
+
+def encode_stream(pcm_chunks, audio_format):
+    """
+    Encode a stream of 16-bit PCM chunks into the given format, in memory, yielding the encoded bytes
+    as soon as the encoder produces them.
+
+    MP3 and Ogg are written front to back so whatever the encoder emitted can be sent right away. FLAC
+    needs to know the length of the whole audio in its header so it's encoded once at the end.
+    """
+    if audio_format == 'wav':
+        yield streaming_wav_header(SAMPLE_RATE)
+        yield from pcm_chunks
+        return
+
+    if audio_format == 'pcm':
+        yield from pcm_chunks
+        return
+
+    file_format, subtype, options = SOUNDFILE_FORMATS[audio_format]
+    buffer = io.BytesIO()
+
+    if audio_format == 'flac':
+        audio = np.frombuffer(b''.join(pcm_chunks), dtype='<i2')
+        sf.write(buffer, audio, SAMPLE_RATE, subtype, format=file_format, **options)
+        yield buffer.getvalue()
+        return
+
+    sent = 0
+
+    def pending():
+        nonlocal sent
+        with buffer.getbuffer() as view:
+            data = bytes(view[sent:])
+        sent += len(data)
+        return data
+
+    with sf.SoundFile(buffer, 'w', SAMPLE_RATE, 1, subtype, format=file_format, **options) as encoder:
+        for pcm in pcm_chunks:
+            encoder.write(np.frombuffer(pcm, dtype='<i2'))
+            data = pending()
+            if data:
+                yield data
+
+    # Closing the encoder flushes its last frames. The MP3 encoder also rewrites its first frame
+    # with a header of the whole stream but we already sent a placeholder for it.
+    data = pending()
+    if data:
+        yield data
+
 
 @app.route('/v1/audio/speech', methods=['POST'])
 def speech_handler():
     data = request.get_json()
 
     if not data or 'input' not in data:
+        REQUESTS.labels('invalid').inc()
         return jsonify({"error": "Invalid request. 'input' field is required."}), 400
 
-    text = data['input']
+    sentences = split_sentences(data['input'])
+    if not sentences:
+        REQUESTS.labels('invalid').inc()
+        return jsonify({"error": "Invalid request. 'input' field is empty."}), 400
+
+    audio_format = data.get('response_format') or DEFAULT_FORMAT
+    if audio_format not in MIMETYPES:
+        REQUESTS.labels('invalid').inc()
+        return jsonify({"error": f"Unsupported response_format '{audio_format}'. Use one of {list(MIMETYPES)}."}), 400
+    mimetype = MIMETYPES[audio_format]
 
     language = app.config['LANGUAGE']
-    model = app.config['TTS_MODEL']
     speed = app.config['TTS_SPEED']
+    cache = app.config['CACHE']
+
+    # Cache hits are answered without touching the pipeline at all.
+    key = cache_key(data['input'], language, app.config['TTS_MODEL_NAME'], speed, audio_format)
+    audio = cache.get(key)
+    if audio is not None:
+        REQUESTS.labels('hit').inc()
+        return Response(audio, mimetype=mimetype), 200
+
+    if not app.config['READY'].is_set():
+        REQUESTS.labels('unavailable').inc()
+        return jsonify({"error": "The model is still warming up, try again later."}), 503
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-        tmp_file_path = tmp_file.name
+    # Queue all the sentences at once, the scheduler takes turns between them and those of other requests.
+    REQUESTS.labels('miss').inc()
+    jobs = app.config['SCHEDULER'].submit(sentences, language, speed)
 
-    model.generate_to_file(tmp_file_path, text, speaker=None, lang=language, cps=speed)
+    def generate():
+        chunks = []
+        IN_FLIGHT.inc()
+        try:
+            for chunk in encode_stream((job.result() for job in jobs), audio_format):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            # Don't synthesize sentences for clients that went away.
+            for job in jobs:
+                job.cancel()
+            IN_FLIGHT.dec()
+        # Only reached if the client read the whole response.
+        cache.put(key, b''.join(chunks))
 
-    return send_file(tmp_file_path, mimetype='audio/wav'), 200
+    return Response(stream_with_context(generate()), mimetype=mimetype), 200
 
 
 @app.route('/status', methods=['GET'])
 def status_handler():
-    return jsonify({"status": "Service is up and running"}), 200
+    if not app.config['READY'].is_set():
+        return jsonify({"status": "Service is warming up"}), 503
+    return jsonify({"status": "Service is up and running", "startup_time": app.config['STARTUP_TIME']}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST), 200
+
+
+def use_model_cache(model_cache_dir, tts_model):
+    """
+    Keep the downloaded model weights and the kernels compiled by torch in the given directory
+    so that they can be reused across restarts.
+
+    Once a model has been warmed up successfully, everything it needs is in the cache and the following
+    startups skip checking the hub for updates. Delete the returned marker file to check again.
+
+    NOTE: This needs to run before torch and the hugging face hub are imported as they read these
+    settings at import time.
+    """
+    model_cache_dir.mkdir(parents=True, exist_ok=True)
+    os.environ.setdefault('HF_HOME', str(model_cache_dir / 'huggingface'))
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(model_cache_dir / 'inductor'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+
+    warm_marker = model_cache_dir / f'{tts_model}.warm'
+    if warm_marker.exists():
+        os.environ.setdefault('HF_HUB_OFFLINE', '1')
+    return warm_marker
+
+
+def warm_up(tts_model, language, tts_speed, warm_marker, *, max_batch_size, max_wait):
+    """Load, compile and warm up the model, then start accepting synthesis requests."""
+    # pylint: disable=import-outside-toplevel
+    from whisperspeech.pipeline import Pipeline
+
+    import batched_pipeline
+
+    start = time.time()
+
+    model = Pipeline(
+        t2s_ref=f"whisperspeech/whisperspeech:t2s-{tts_model}-en+pl.model",
+        s2a_ref=f"whisperspeech/whisperspeech:s2a-q4-{tts_model}-en+pl.model",
+        optimize=False,
+    )
+
+    def synthesize_batch(sentences):
+        return batched_pipeline.synthesize_batch(model, sentences, max_batch_size)
+
+    # Test that models work, and compile them for every batch size, before exposing the service.
+    try:
+        batched_pipeline.optimize(model, max_batch_size)
+        for batch_size in batched_pipeline.batch_sizes(max_batch_size):
+            synthesize_batch([("this is a test", language, tts_speed)] * batch_size)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception("Failed to warm up the model. If it's missing from the cache, remove %s", warm_marker)
+        return
+    warm_marker.touch()
+
+    app.config['SCHEDULER'] = SynthesisScheduler(synthesize_batch, max_batch_size, max_wait)
+    app.config['STARTUP_TIME'] = time.time() - start
+    app.config['READY'].set()
+    logging.info("Model warmed up in %.1f seconds", app.config['STARTUP_TIME'])
 
 
 @click.command()
@@ -41,22 +247,50 @@ def status_handler():
 @click.option('--language', default='en', help='The language to expect.')
 @click.option('--tts_model', default='tiny', help='WhisperSpeech model to use (e.g., tiny, base, small, hq-fast).')
 @click.option('--tts_speed', default=15, help='Characters per second to speak.')
-def main(host, port, language, tts_model, tts_speed):
+@click.option('--max_batch_size', default=8, help='Maximum number of sentences to synthesize in one batch.')
+@click.option('--max_wait_ms', default=20, help='Maximum time to wait for more sentences to fill a batch.')
+@click.option('--cache_dir', default='~/.cache/fably/tts_server', help='Directory to cache synthesized audio in.')
+@click.option('--cache_size_mb', default=1024, help='Disk budget of the synthesis cache in MB (0 disables it).')
+@click.option('--hot_cache_size_mb', default=32, help='Memory budget of the synthesis cache in MB (0 disables it).')
+@click.option(
+    '--model_cache_dir',
+    default='~/.cache/fably/tts_server_models',
+    help='Directory to keep the model weights and compiled kernels in across restarts.',
+)
+def main(
+    host,
+    port,
+    language,
+    tts_model,
+    tts_speed,
+    max_batch_size,
+    max_wait_ms,
+    cache_dir,
+    cache_size_mb,
+    hot_cache_size_mb,
+    model_cache_dir,
+):
+    logging.basicConfig(level=logging.INFO)
 
-    model = Pipeline(
-        t2s_ref=f"whisperspeech/whisperspeech:t2s-{tts_model}-en+pl.model",
-        s2a_ref=f"whisperspeech/whisperspeech:s2a-q4-{tts_model}-en+pl.model",
-        torch_compile=True
-    )
+    warm_marker = use_model_cache(Path(model_cache_dir).expanduser(), tts_model)
 
+    app.config['READY'] = threading.Event()
     app.config['LANGUAGE'] = language
-    app.config['TTS_MODEL'] = model
+    app.config['TTS_MODEL_NAME'] = tts_model
     app.config['TTS_SPEED'] = tts_speed
+    app.config['CACHE'] = SynthesisCache(
+        Path(cache_dir).expanduser(), cache_size_mb * 1024 * 1024, hot_cache_size_mb * 1024 * 1024
+    )
 
-    # Test that models work before exposing the service.
-    model.generate("this is a test", speaker=None, lang=language, cps=tts_speed)
+    # Serve right away, /status reports when the model is ready to take synthesis requests.
+    threading.Thread(
+        target=warm_up,
+        args=(tts_model, language, tts_speed, warm_marker),
+        kwargs={'max_batch_size': max_batch_size, 'max_wait': max_wait_ms / 1000},
+        daemon=True,
+    ).start()
 
-    app.run(host=host, port=port)
+    app.run(host=host, port=port, threaded=True)
 
 
 if __name__ == '__main__':
@@ -23,5 +23,6 @@ setup(
     entry_points='''
         [console_scripts]
         fably=fably.cli:cli
+        fably-batch=fably.batch:main
     ''',
 )
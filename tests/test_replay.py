@@ -0,0 +1,45 @@
+"""Make sure replayed stories play all their paragraphs."""
+
+import io
+
+import numpy as np
+import soundfile as sf
+
+from fably import bundle
+from fably import replay
+from fably import utils
+
+SAMPLE_RATE = 16000
+DURATIONS = (1.0, 1.5, 1.0)
+
+
+def write_story(story_path):
+    story_path.mkdir()
+    for index, duration in enumerate(DURATIONS):
+        (story_path / f"paragraph_{index}.txt").write_text(f"Paragraph {index}.", encoding="utf8")
+        samples = np.sin(np.arange(int(duration * SAMPLE_RATE)) * 0.05) * 0.1
+        sf.write(story_path / f"paragraph_{index}.mp3", samples, SAMPLE_RATE, format="MP3")
+    utils.mark_story_complete(story_path)
+
+
+def replayed_duration(story_path):
+    manifest = replay.read_manifest(story_path)
+    # This is what gets piped into mpg123.
+    audio = b"".join(replay._read_mp3_stream(manifest))  # pylint: disable=protected-access
+    return sf.info(io.BytesIO(audio)).duration
+
+
+def test_replay_directory(tmp_path):
+    story_path = tmp_path / "story"
+    write_story(story_path)
+    assert replayed_duration(story_path) >= sum(DURATIONS)
+
+
+def test_replay_bundle(tmp_path):
+    story_path = tmp_path / "story"
+    write_story(story_path)
+    bundle.pack_story(story_path)
+    for path in story_path.iterdir():
+        path.unlink()
+    story_path.rmdir()
+    assert replayed_duration(story_path) >= sum(DURATIONS)
@@ -74,7 +74,7 @@ def main(stt_url, stt_model, sound_model, language, sound_driver, trim_first_fra
 
     print("Say something...")
 
-    voice_query, voice_query_sample_rate, query_local = utils.record_until_silence(
+    voice_query, voice_query_sample_rate, query_local, confidence = utils.record_until_silence(
         recognizer, trim_first_frame
     )
     query_cloud, voice_query_file = utils.transcribe(
@@ -87,7 +87,7 @@ def main(stt_url, stt_model, sound_model, language, sound_driver, trim_first_fra
 
     utils.play_audio_file(voice_query_file, sound_driver)
 
-    print(f"Local transcription: {query_local}")
+    print(f"Local transcription: {query_local} (confidence {confidence:.2f})")
     print(f"Cloud transcription: {query_cloud}")
 
 
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
-"""Concatenate audio files in a directory into a single audio file."""
+"""Concatenate the paragraph audio files of story directories into a single audio file per story.
 
+This is what Fably does in the background for the stories it tells, see fably/render.py. Story directories
+are processed in parallel and the ones whose story file is newer than all their paragraphs are skipped.
+"""
+
+import concurrent.futures
 import os
 
+from pathlib import Path
+
 import click
-from pydub import AudioSegment
+import soundfile as sf
+
+from fably import render
 
 FORMAT = "mp3"
 
@@ -13,38 +22,44 @@ FORMAT = "mp3"
 @click.option(
     "--folder",
     "-f",
-    type=click.Path(exists=True),
-    help="Root folder to start searching for MP3 files.",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+    help="Root folder to start searching for story directories.",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(list(render.SOUNDFILE_FORMATS)),
+    default=FORMAT,
+    help=f'The format of the concatenated story. Defaults to "{FORMAT}".',
 )
-def main(folder):
-    # Walk through all directories and subdirectories starting from the root folder
-    for root, _, files in os.walk(folder):
-        # Prepare the path for the output file
-        output_path = os.path.join(root, f"story.{FORMAT}")
-
-        # Skip concatenation if 'story.mp3' already exists
-        if os.path.exists(output_path):
-            click.echo(f"Skipping concatenation, {output_path} already exists.")
-            continue
-
-        # Filter and sort audio files
-        audio_files = [f for f in sorted(files) if f.endswith(f".{FORMAT}")]
-        if not audio_files:
-            continue  # Skip if no MP3 files found in the current directory
-
-        # Create an empty AudioSegment object
-        combined = AudioSegment.silent(duration=0)
-
-        # Loop through sorted files and append each to the combined audio
-        for filename in audio_files:
-            filepath = os.path.join(root, filename)
-            audio = AudioSegment.from_mp3(filepath)
-            combined += audio
-            click.echo(f"Appended {filename} in {root}")
-
-        # Export the combined audio to a new file named 'story.mp3'
-        combined.export(output_path, format=FORMAT)
-        click.echo(f"Combined audio files saved as {output_path}")
+@click.option(
+    "--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="The number of stories to concatenate in parallel. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Concatenate the stories again even if they are up to date.",
+)
+def main(folder, output_format, workers, force):
+    story_paths = [Path(root) for root, _, _ in os.walk(folder)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(render.render_story, story_path, output_format, force): story_path
+            for story_path in story_paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                message = future.result()
+            except (sf.LibsndfileError, RuntimeError, ValueError, OSError) as e:
+                message = f"Failed to concatenate {futures[future]}: {e}"
+            if message:
+                click.echo(message)
 
 
 if __name__ == "__main__":
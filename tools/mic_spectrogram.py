@@ -8,6 +8,7 @@ import numpy as np
 import sounddevice as sd
 import click
 
+from fably import audio_analysis
 
 # Try to get terminal size or default to 80
 try:
@@ -67,6 +68,8 @@ def main(list_devices, block_duration, columns, device, gain, frequency_range):
     delta_f = (high - low) / (columns - 1)
     fftsize = math.ceil(samplerate / delta_f)
     low_bin = math.floor(low / delta_f)
+    blocksize = int(samplerate * block_duration / 1000)
+    analyzer = audio_analysis.BlockAnalyzer(blocksize, fftsize)
 
     def callback(indata, _frames, _time, status):
         if status:
@@ -74,12 +77,9 @@ def main(list_devices, block_duration, columns, device, gain, frequency_range):
             print("\x1b[34;40m", text.center(columns, "#"), "\x1b[0m", sep="")
 
         if any(indata):
-            magnitude = np.abs(np.fft.rfft(indata[:, 0], n=fftsize))
-            magnitude *= gain / fftsize
-            line = (
-                gradient[int(np.clip(x, 0, 1) * (len(gradient) - 1))]
-                for x in magnitude[low_bin : low_bin + columns]
-            )
+            magnitude = analyzer.spectrum(indata[:, 0])[low_bin : low_bin + columns]
+            levels = np.clip(magnitude * gain, 0, 1) * (len(gradient) - 1)
+            line = (gradient[int(level)] for level in levels)
             print(*line, sep="", end="\x1b[0m\n")
         else:
             print("no input")
@@ -88,7 +88,7 @@ def main(list_devices, block_duration, columns, device, gain, frequency_range):
         device=device,
         channels=1,
         callback=callback,
-        blocksize=int(samplerate * block_duration / 1000),
+        blocksize=blocksize,
         samplerate=samplerate,
     ):
         while True:
@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 """Show the the mic noise floor (in RMS energy) using sounddevice."""
 
-import numpy as np
 import sounddevice as sd
 
+from fably import audio_analysis
+
 CHANNELS = 1  # Number of audio channels (mono)
 RATE = 16000  # Sample rate
 CHUNK = RATE // 4  # Number of frames per buffer
 
 
 def main():
+    noise_floor = audio_analysis.measure_noise_floor(RATE)
+    print(
+        f"Noise floor: {noise_floor:.3f}, "
+        f"silence threshold: {audio_analysis.silence_threshold(noise_floor):.3f}"
+    )
 
-    def rms(data):
-        return np.sqrt(np.mean(np.square(data)))
+    analyzer = audio_analysis.BlockAnalyzer(CHUNK)
 
     def callback(in_data, _frame_count, _time_info, _status):
-        data = in_data[:, 0]
-        energy = rms(data)
+        energy = analyzer.rms(in_data[:, 0])
         print(f"RMS: {energy:.3f}")
 
     try:
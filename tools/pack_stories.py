@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Pack cached story directories into single-file story bundles."""
+
+import shutil
+
+from pathlib import Path
+
+import click
+
+from fably import bundle
+from fably import utils
+
+
+@click.command()
+@click.option(
+    "--folder",
+    "-f",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+    help="Folder containing the story directories to pack (e.g. the stories path).",
+)
+@click.option(
+    "--remove/--keep",
+    default=False,
+    help="Whether to remove the story directories (including their voice queries) once they have been packed.",
+)
+def main(folder, remove):
+    utils.migrate_legacy_stories(folder)
+
+    for story_path in sorted(Path(folder).iterdir()):
+        if not story_path.is_dir() or not (story_path / "paragraph_0.txt").exists():
+            continue
+
+        bundle_file = bundle.bundle_path(story_path)
+        if bundle_file.exists():
+            click.echo(f"Skipping {story_path}, {bundle_file} already exists.")
+            continue
+
+        try:
+            bundle.pack_story(story_path, bundle_file)
+        except ValueError as e:
+            click.echo(f"Skipping {story_path}: {e}")
+            continue
+
+        with bundle.StoryBundle(bundle_file) as story:
+            click.echo(f"Packed {len(story)} paragraphs of {story_path} into {bundle_file}")
+
+        if remove:
+            shutil.rmtree(story_path)
+
+
+if __name__ == "__main__":
+    main()
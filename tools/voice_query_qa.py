@@ -42,7 +42,7 @@ def released(ctx):
     elif pressed_for < ctx.button.hold_time:
         print("This is a long press. Recording a sound...")
         utils.play_sound("what_story", audio_driver=ctx.sound_driver)
-        audio_data, sample_rate, _ = utils.record_until_silence(ctx.recognizer)
+        audio_data, sample_rate, _, _ = utils.record_until_silence(ctx.recognizer)
         audio_file = time.strftime("%d_%m_%Y-%H_%M_%S") + "_voice.wav"
         utils.write_audio_data_to_file(audio_data, audio_file, sample_rate)
         print("Finished recording.")